@@ -0,0 +1,479 @@
+"""Офлайн-бенчмарк бота: поднимает main:app (uvicorn, отдельный процесс) против локальных
+заглушек Bot API и YooKassa и прогоняет синтетические потоки апдейтов через
+/telegram/webhook и /webhook/yookassa.
+
+Фазы:
+  onboarding — /start, имя, email для каждого пользователя;
+  plans      — выбор пакета (создание платежа в YooKassa);
+  payments   — всплеск подтверждений: вебхук YooKassa + несколько нажатий «проверить».
+
+Отчёт: p50/p99 времени ответа вебхука (ack) и полного цикла до ответа бота (e2e),
+пропускная способность, число вызовов Bot API / YooKassa и записей в БД (из /metrics).
+
+    python bench.py --users 200 --concurrency 50 --tg-latency 30 --yk-latency 150
+    python bench.py --save bench_baseline.json
+    python bench.py --baseline bench_baseline.json --tolerance 0.2   # код 1 при регрессии
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import itertools
+import subprocess
+from collections import Counter, defaultdict, deque
+
+import aiohttp
+from aiohttp import web
+
+BOT_TOKEN = "123456:BENCH"
+GROUP_ID = -100123456
+YOOKASSA_IP = "185.71.76.1"  # из списка доверенных адресов YooKassa
+
+DB_WRITE_PREFIXES = ("db_upsert", "db_create", "db_transition", "db_add", "db_mark", "db_take",
+                     "db_claim", "db_set", "db_update", "db_delete")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Stats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+
+    def add(self, name: str, seconds: float):
+        self.samples[name].append(seconds)
+
+    def summary(self, name: str) -> dict:
+        v = self.samples.get(name, [])
+        return {"count": len(v), "p50_ms": round(percentile(v, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(v, 0.99) * 1000, 2)}
+
+
+# ---------------- Заглушки ----------------
+class FakeTelegram:
+    """Bot API: отвечает правдоподобными объектами, задержка и доля 429 настраиваются.
+    Каждый вызов «будит» того, кто ждёт ответа бота в этот чат (или на этот callback)."""
+
+    def __init__(self, latency: float, error_rate: float, rng: random.Random):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng
+        self.calls = Counter()
+        self.paid_messages = Counter()
+        self._waiters = defaultdict(deque)
+        self._ids = itertools.count(1)
+
+    def expect(self, key) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[key].append(fut)
+        return fut
+
+    def _notify(self, key):
+        q = self._waiters.get(key)
+        while q:
+            fut = q.popleft()
+            if not fut.done():
+                fut.set_result(time.perf_counter())
+                return
+
+    def _message(self, chat_id, text=""):
+        return {"message_id": next(self._ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}, "text": text}
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        self.calls[method] += 1
+        if method != "setWebhook" and self.rng.random() < self.error_rate:
+            self.calls["429"] += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": 1}}, status=429)
+
+        chat_id = int(data["chat_id"]) if "chat_id" in data else None
+        text = data.get("text", "")
+        if method == "answerCallbackQuery":
+            self._notify(("cb", data.get("callback_query_id")))
+            return web.json_response({"ok": True, "result": True})
+        if chat_id is not None:
+            if text.startswith("Оплата подтверждена"):
+                self.paid_messages[chat_id] += 1
+                self._notify(("paid", chat_id))
+            self._notify(("chat", chat_id))
+
+        if method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text)
+        elif method == "copyMessage":
+            result = {"message_id": next(self._ids)}
+        elif method in ("createChatInviteLink", "revokeChatInviteLink"):
+            revoke = method == "revokeChatInviteLink"
+            result = {"invite_link": data["invite_link"] if revoke else f"https://t.me/+bench{next(self._ids)}",
+                      "creator": {"id": 1, "is_bot": True, "first_name": "bench"},
+                      "creates_join_request": False, "is_primary": False, "is_revoked": revoke,
+                      "member_limit": 1, "expire_date": int(data.get("expire_date") or 0)}
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeYooKassa:
+    """YooKassa /v3/payments: создание, получение и список платежей."""
+
+    def __init__(self, latency: float, error_rate: float, rng: random.Random):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng
+        self.calls = Counter()
+        self.payments = {}
+        self.by_key = {}
+
+    async def _delay(self, op: str):
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        self.calls[op] += 1
+        if self.rng.random() < self.error_rate:
+            self.calls["error"] += 1
+            raise web.HTTPInternalServerError(text='{"type":"error","code":"internal_server_error"}')
+
+    async def create(self, request: web.Request):
+        await self._delay("create")
+        body = await request.json()
+        key = request.headers.get("Idempotence-Key")
+        if key in self.by_key:
+            return web.json_response(self.payments[self.by_key[key]])
+        pid = f"bench-{len(self.payments) + 1:08d}"
+        self.payments[pid] = {
+            "id": pid, "status": "pending", "paid": False,
+            "amount": body["amount"], "metadata": body.get("metadata") or {},
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.test/pay/{pid}"},
+        }
+        if key:
+            self.by_key[key] = pid
+        return web.json_response(self.payments[pid])
+
+    async def get(self, request: web.Request):
+        await self._delay("get")
+        payment = self.payments.get(request.match_info["payment_id"])
+        if not payment:
+            raise web.HTTPNotFound(text='{"type":"error","code":"not_found"}')
+        return web.json_response(payment)
+
+    async def list(self, request: web.Request):
+        await self._delay("list")
+        status = request.query.get("status")
+        items = [p for p in self.payments.values() if not status or p["status"] == status]
+        return web.json_response({"type": "list", "items": items[:100]})
+
+    def succeed(self, pid: str):
+        self.payments[pid].update(status="succeeded", paid=True)
+
+
+# ---------------- Генерация апдейтов ----------------
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._cb_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"User{uid}"}
+
+    def message(self, uid: int, text: str) -> dict:
+        return {"update_id": next(self._update_ids), "message": {
+            "message_id": next(self._update_ids), "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"}, "from": self._user(uid), "text": text}}
+
+    def callback(self, uid: int, data: str):
+        cb_id = str(next(self._cb_ids))
+        return cb_id, {"update_id": next(self._update_ids), "callback_query": {
+            "id": cb_id, "from": self._user(uid), "chat_instance": str(uid), "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+                        "from": {"id": 1, "is_bot": True, "first_name": "bench"}, "text": "menu"}}}
+
+
+# ---------------- Прогон ----------------
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.tg = FakeTelegram(args.tg_latency / 1000, args.tg_error_rate, self.rng)
+        self.yk = FakeYooKassa(args.yk_latency / 1000, args.yk_error_rate, self.rng)
+        self.updates = UpdateFactory()
+        self.stats = Stats()
+        self.phases = {}
+        self.app_url = None
+        self.http = None
+
+    async def _start_fakes(self):
+        tg_app = web.Application()
+        tg_app.router.add_post("/bot{token}/{method}", self.tg.handle)
+        yk_app = web.Application()
+        yk_app.router.add_post("/v3/payments", self.yk.create)
+        yk_app.router.add_get("/v3/payments", self.yk.list)
+        yk_app.router.add_get("/v3/payments/{payment_id}", self.yk.get)
+        self._runners = []
+        ports = []
+        for app in (tg_app, yk_app):
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            port = free_port()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+            self._runners.append(runner)
+            ports.append(port)
+        return ports
+
+    def _start_app(self, tg_port: int, yk_port: int, workdir: str):
+        port = free_port()
+        self.app_url = f"http://127.0.0.1:{port}"
+        env = {
+            **os.environ,
+            "BOT_TOKEN": BOT_TOKEN,
+            "PUBLIC_BASE_URL": self.app_url,
+            "GROUP_ID": str(GROUP_ID),
+            "YOOKASSA_SHOP_ID": "bench",
+            "YOOKASSA_SECRET_KEY": "bench",
+            "YOOKASSA_API_URL": f"http://127.0.0.1:{yk_port}/v3",
+            "TELEGRAM_API_URL": f"http://127.0.0.1:{tg_port}",
+            "DB_FILE": os.path.join(workdir, "bench.db"),
+            "REMINDER_DELAY": os.environ.get("REMINDER_DELAY", "86400"),
+            "RECONCILE_INTERVAL": os.environ.get("RECONCILE_INTERVAL", "3600"),
+            "WEB_CONCURRENCY": str(self.args.workers),
+            # бенчмарк сам играет роль прокси на 127.0.0.1 и проставляет X-Forwarded-For
+            "YOOKASSA_TRUST_WEBHOOKS": "0" if self.args.untrusted_webhooks else "1",
+            "YOOKASSA_TRUSTED_PROXIES": "127.0.0.1/32",
+        }
+        cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+               "--log-level", "warning", "--workers", str(self.args.workers)]
+        return subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                stdout=subprocess.DEVNULL if not self.args.verbose else None)
+
+    async def _wait_ready(self, proc, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"app exited with code {proc.returncode}")
+            try:
+                async with self.http.get(f"{self.app_url}/") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError("app did not start in time")
+
+    async def _metrics(self) -> dict:
+        async with self.http.get(f"{self.app_url}/metrics", params={"token": os.environ.get("METRICS_TOKEN", "")}) as r:
+            text = await r.text()
+        counts = {}
+        for fn, value in re.findall(r'^db_query_seconds_count\{fn="([^"]+)"\} (\S+)$', text, re.M):
+            counts[fn] = counts.get(fn, 0) + float(value)
+        return counts
+
+    async def _post(self, path: str, payload: dict, name: str, headers: dict = None):
+        # Как Telegram/YooKassa: при 5xx повторяем доставку
+        for attempt in range(5):
+            start = time.perf_counter()
+            try:
+                async with self.http.post(f"{self.app_url}{path}", json=payload, headers=headers) as r:
+                    await r.read()
+                    status = r.status
+            except aiohttp.ClientError:
+                status = 0
+            self.stats.add(f"{name}.ack", time.perf_counter() - start)
+            if status == 200:
+                return
+            self.stats.errors[f"{name}.http_{status}"] += 1
+            await asyncio.sleep(0.2 * (attempt + 1))
+
+    async def _roundtrip(self, name: str, key, update: dict):
+        waiter = self.tg.expect(key)
+        start = time.perf_counter()
+        await self._post("/telegram/webhook", update, name)
+        try:
+            done = await asyncio.wait_for(waiter, self.args.timeout)
+            self.stats.add(f"{name}.e2e", done - start)
+        except asyncio.TimeoutError:
+            self.stats.errors[f"{name}.timeout"] += 1
+
+    async def _run_phase(self, name: str, users: list, per_user, n_updates_per_user: int):
+        sem = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(uid):
+            async with sem:
+                await per_user(uid)
+
+        db_before = await self._metrics()
+        start = time.perf_counter()
+        await asyncio.gather(*(one(uid) for uid in users))
+        elapsed = time.perf_counter() - start
+        db_after = await self._metrics()
+        calls = {fn: int(db_after.get(fn, 0) - db_before.get(fn, 0)) for fn in db_after}
+        calls = {fn: n for fn, n in calls.items() if n}
+        self.phases[name] = {
+            "updates": len(users) * n_updates_per_user,
+            "seconds": round(elapsed, 3),
+            "throughput_per_s": round(len(users) * n_updates_per_user / elapsed, 1) if elapsed else 0,
+            "db_calls": sum(calls.values()),
+            "db_writes": sum(n for fn, n in calls.items() if fn.startswith(DB_WRITE_PREFIXES)),
+            "db_by_fn": calls,
+        }
+
+    async def onboarding(self, uid: int):
+        for text in ("/start", f"User{uid}", f"user{uid}@bench.test"):
+            await self._roundtrip("onboarding", ("chat", uid), self.updates.message(uid, text))
+
+    async def choose_plan(self, uid: int):
+        cb_id, update = self.updates.callback(uid, f"plan:{self.args.plan}")
+        await self._roundtrip("plans", ("cb", cb_id), update)
+
+    async def confirm_payment(self, uid: int):
+        payment = self._payments_by_user.get(uid)
+        if not payment:
+            self.stats.errors["payments.no_payment"] += 1
+            return
+        self.yk.succeed(payment["id"])
+        waiter = self.tg.expect(("paid", uid))
+        start = time.perf_counter()
+        headers = {} if self.args.untrusted_webhooks else {"X-Forwarded-For": YOOKASSA_IP}
+        notification = {"type": "notification", "event": "payment.succeeded", "object": self.yk.payments[payment["id"]]}
+        inv_id = payment["metadata"]["invoice_id"]
+        presses = [self._roundtrip("payments.check", ("cb", cb_id), update)
+                   for cb_id, update in (self.updates.callback(uid, f"check:{inv_id}") for _ in range(self.args.check_presses))]
+        await asyncio.gather(self._post("/webhook/yookassa", notification, "payments.webhook", headers), *presses)
+        try:
+            done = await asyncio.wait_for(waiter, self.args.timeout)
+            self.stats.add("payments.e2e", done - start)
+        except asyncio.TimeoutError:
+            self.stats.errors["payments.timeout"] += 1
+
+    async def run(self) -> dict:
+        with tempfile.TemporaryDirectory() as workdir:
+            tg_port, yk_port = await self._start_fakes()
+            proc = self._start_app(tg_port, yk_port, workdir)
+            connector = aiohttp.TCPConnector(limit=self.args.concurrency * (self.args.check_presses + 2))
+            self.http = aiohttp.ClientSession(connector=connector)
+            try:
+                await self._wait_ready(proc)
+                users = list(range(10_000, 10_000 + self.args.users))
+                await self._run_phase("onboarding", users, self.onboarding, 3)
+                await self._run_phase("plans", users, self.choose_plan, 1)
+                self._payments_by_user = {}
+                for p in self.yk.payments.values():
+                    inv = p["metadata"].get("invoice_id", "")
+                    uid = int(inv.split("_")[1]) if inv.count("_") >= 2 else None
+                    self._payments_by_user[uid] = p
+                await self._run_phase("payments", users, self.confirm_payment, 1 + self.args.check_presses)
+            finally:
+                await self.http.close()
+                proc.terminate()
+                try:
+                    proc.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                for runner in self._runners:
+                    await runner.cleanup()
+
+        latency = {name: self.stats.summary(name) for name in sorted(self.stats.samples)}
+        duplicates = sum(n - 1 for n in self.tg.paid_messages.values() if n > 1)
+        return {
+            "config": {k: v for k, v in vars(self.args).items() if k not in ("save", "baseline")},
+            "phases": self.phases,
+            "latency": latency,
+            "errors": dict(self.stats.errors),
+            "bot_api_calls": dict(self.tg.calls),
+            "yookassa_calls": dict(self.yk.calls),
+            "duplicate_access_messages": duplicates,
+        }
+
+
+def print_report(result: dict):
+    print("phase        updates   sec   upd/s  db_calls  db_writes")
+    for name, p in result["phases"].items():
+        print(f"{name:<12} {p['updates']:>7} {p['seconds']:>6} {p['throughput_per_s']:>6} {p['db_calls']:>9} {p['db_writes']:>10}")
+    print("\nlatency                    count    p50 ms    p99 ms")
+    for name, s in result["latency"].items():
+        print(f"{name:<25} {s['count']:>6} {s['p50_ms']:>9} {s['p99_ms']:>9}")
+    print("\nbot api calls:", result["bot_api_calls"])
+    print("yookassa calls:", result["yookassa_calls"])
+    print("errors:", result["errors"] or "none")
+    print("duplicate access messages:", result["duplicate_access_messages"])
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    problems = []
+    for name, s in result["latency"].items():
+        base = baseline.get("latency", {}).get(name)
+        if base and name.endswith(".e2e") and base["p99_ms"] and s["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            problems.append(f"{name} p99 {s['p99_ms']} ms > baseline {base['p99_ms']} ms")
+    for name, p in result["phases"].items():
+        base = baseline.get("phases", {}).get(name)
+        if base and p["throughput_per_s"] < base["throughput_per_s"] * (1 - tolerance):
+            problems.append(f"{name} throughput {p['throughput_per_s']}/s < baseline {base['throughput_per_s']}/s")
+        if base and p["db_writes"] > base["db_writes"] * (1 + tolerance):
+            problems.append(f"{name} db writes {p['db_writes']} > baseline {base['db_writes']}")
+    if result["duplicate_access_messages"]:
+        problems.append(f"{result['duplicate_access_messages']} duplicate access messages")
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=50, help="пользователей одновременно")
+    ap.add_argument("--plan", default="basic")
+    ap.add_argument("--check-presses", type=int, default=2, help="нажатий «проверить» на каждый платёж")
+    ap.add_argument("--tg-latency", type=float, default=20, help="мс, задержка Bot API")
+    ap.add_argument("--tg-error-rate", type=float, default=0.0, help="доля ответов 429")
+    ap.add_argument("--yk-latency", type=float, default=100, help="мс, задержка YooKassa")
+    ap.add_argument("--yk-error-rate", type=float, default=0.0, help="доля ответов 500")
+    ap.add_argument("--untrusted-webhooks", action="store_true", help="слать вебхуки YooKassa не с её адресов")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="uvicorn --workers (db_* в отчёте тогда — только по одному воркеру, см. /metrics)")
+    ap.add_argument("--timeout", type=float, default=30, help="сек, ожидание ответа бота")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true", help="вывести результат как JSON")
+    ap.add_argument("--save", help="сохранить результат (JSON) — например, как baseline")
+    ap.add_argument("--baseline", help="сравнить с сохранённым результатом")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="допустимая регрессия (доля)")
+    ap.add_argument("--verbose", action="store_true", help="не глушить stdout приложения")
+    args = ap.parse_args()
+
+    result = asyncio.run(Bench(args).run())
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for p in problems:
+            print("REGRESSION:", p)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,47 @@
+import io
 import os
+import sys
+import csv
+import hmac
+import gzip
+import json
 import time
 import uuid
+import queue
+import logging
+import logging.handlers
+import contextvars
+import random
+import contextlib
+import socket
+import inspect
+import ipaddress
 import sqlite3
+import heapq
+import bisect
+import itertools
 import asyncio
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
+from string import Template
 
-import requests
-from fastapi import FastAPI, Request
+import aiohttp
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, CallbackQuery, ChatMemberUpdated
+from aiogram.types import (
+    CallbackQuery, ChatMemberUpdated, InlineKeyboardButton, InlineKeyboardMarkup, Message,
+)
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 # ---------------- ENV (Railway) ----------------
@@ -27,6 +58,9 @@ YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
 
 # Контакты и настройки
 ADMIN_USERNAME = "kairos_007"     # Тех. поддержка (без @)
+# Кому доступны админ-команды (/broadcast): user_id через запятую. Только по id — username можно
+# сменить, а освободившийся занять. Пусто — админ-команды выключены.
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().lstrip("-").isdigit()}
 EXPERT_USERNAME = "Liya_Sharova"  # Эксперт (без @)
 SECRET_WORD = "лапки-лапки"
 
@@ -37,11 +71,267 @@ if not GROUP_ID:
 if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
     raise RuntimeError("Нужно задать YOOKASSA_SHOP_ID и YOOKASSA_SECRET_KEY в ENV")
 
-# ---------------- Database ----------------
-DB_FILE = "bot_database.db"
+# ---------------- Процессы ----------------
+# Число uvicorn-воркеров (uvicorn сам читает WEB_CONCURRENCY как значение --workers по умолчанию).
+# Воркеры делят одну SQLite (WAL); фоновые задачи разбираются через аренды в таблице leases.
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+# ---------------- Логи ----------------
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Сэмплирование частых событий: "YOOKASSA_WEBHOOK_IN=0.1,TG_UPDATE=0.01" (WARNING и выше — всегда)
+LOG_SAMPLE = {
+    k.strip(): float(v) for k, v in
+    (item.split("=", 1) for item in os.getenv("LOG_SAMPLE", "").split(",") if "=" in item)
+}
+
+_log_ctx = contextvars.ContextVar("log_ctx", default={})
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "event": record.getMessage(),
+            "worker": os.getpid(),
+        }
+        data.update(getattr(record, "ctx", None) or {})
+        data.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в ограниченную очередь и сразу возвращается: форматирование и запись
+    в stdout — в фоновом потоке QueueListener. Если очередь полна, запись выбрасывается
+    и учитывается в dropped, обработчик никогда не ждёт медленный вывод."""
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record  # форматирует уже поток-писатель
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+log = logging.getLogger("bot")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_handler = DroppingQueueHandler(_log_queue)
+log.addHandler(_log_handler)
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(JsonFormatter())
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+
+def log_event(event: str, level: int = logging.INFO, exc_info=None, **fields):
+    """Структурное событие: имя + поля + текущий контекст (invoice_id, payment_id, update_id...)."""
+    if not log.isEnabledFor(level):
+        return
+    rate = LOG_SAMPLE.get(event)
+    if rate is not None and level < logging.WARNING and random.random() >= rate:
+        return
+    log.log(level, event, exc_info=exc_info, extra={"ctx": _log_ctx.get(), "fields": fields})
+
+@contextlib.contextmanager
+def log_context(**fields):
+    token = _log_ctx.set({**_log_ctx.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_ctx.reset(token)
+
+def stop_logging():
+    _log_listener.stop()  # дописывает всё, что осталось в очереди
+
+# ---------------- Метрики ----------------
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # если задан — /metrics только с ним
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """Минимальный реестр счётчиков/гистограмм в формате Prometheus. Пишется только
+    с event loop, запись — пара операций со словарём, так что можно держать включённым в проде."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}    # (name, labels) -> value
+        self._gauges = {}      # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [counts по бакетам..., +Inf, sum]
+        self._help = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, labels: tuple, value: float):
+        self._gauges[(name, labels)] = value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        h = self._histograms.get((name, labels))
+        if h is None:
+            h = self._histograms[(name, labels)] = [0] * (len(self.buckets) + 2)
+        h[bisect.bisect_left(self.buckets, value)] += 1
+        h[-1] += value
+
+    def swallowed(self, where: str):
+        self.inc("bot_swallowed_exceptions_total", (("where", where),))
+
+    @staticmethod
+    def _fmt_labels(labels: tuple, extra: tuple = ()) -> str:
+        items = labels + extra
+        if not items:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    def render(self) -> str:
+        out = []
+        seen = set()
+
+        def head(name, default_kind):
+            if name not in seen:
+                seen.add(name)
+                kind, text = self._help.get(name, (default_kind, ""))
+                if text:
+                    out.append(f"# HELP {name} {text}")
+                out.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            head(name, "counter")
+            out.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for (name, labels), value in sorted(self._gauges.items()):
+            head(name, "gauge")
+            out.append(f"{name}{self._fmt_labels(labels)} {value}")
+        for (name, labels), h in sorted(self._histograms.items()):
+            head(name, "histogram")
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), h[:-1]):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append(f"{name}_bucket{self._fmt_labels(labels, (('le', le),))} {total}")
+            out.append(f"{name}_sum{self._fmt_labels(labels)} {h[-1]}")
+            out.append(f"{name}_count{self._fmt_labels(labels)} {total}")
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "aiogram handler latency")
+metrics.describe("bot_op_seconds", "histogram", "Latency of internal operations (grant_access, ...)")
+metrics.describe("yookassa_request_seconds", "histogram", "YooKassa API call latency")
+metrics.describe("db_query_seconds", "histogram", "db_* call latency including executor wait")
+metrics.describe("telegram_api_seconds", "histogram", "Bot API call latency by method")
+metrics.describe("event_loop_lag_seconds", "histogram", "Event loop scheduling lag")
+metrics.describe("bot_swallowed_exceptions_total", "counter", "Exceptions caught and not re-raised")
+
+def timed(name: str, label: str, value: str):
+    """Декоратор для корутин: гистограмма name{label=value} и счётчик ошибок name_errors_total."""
+    labels = ((label, value),)
+    errors = name.removesuffix("_seconds") + "_errors_total"
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                metrics.inc(errors, labels)
+                raise
+            finally:
+                metrics.observe(name, labels, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+async def monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = max(loop.time() - start - EVENT_LOOP_LAG_INTERVAL, 0.0)
+        metrics.observe("event_loop_lag_seconds", (), lag)
+        metrics.set("event_loop_lag_last_seconds", (), lag)
 
+# ---------------- Database ----------------
+DB_FILE = os.getenv("DB_FILE", "bot_database.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+# Соединения живут всё время работы приложения: по одному на поток выделенного пула,
+# так что запросы к SQLite (и fsync при коммите) не блокируют event loop.
+_db_local = threading.local()
+_db_conns = []
+_db_conns_lock = threading.Lock()
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="sqlite")
+
+def db_connect() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        # до WAL: новая база сразу создаётся с INCREMENTAL, существующую переводит db_enable_incremental_vacuum
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # в WAL-режиме безопасно и без fsync на каждый коммит
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")  # ~8 МБ страниц на соединение
+        conn.execute("PRAGMA foreign_keys=ON")
+        _db_local.conn = conn
+        with _db_conns_lock:
+            _db_conns.append(conn)
+    return conn
+
+def db_call(fn):
+    """Делает из синхронной функции БД корутину, которая выполняется в пуле потоков SQLite.
+    Синхронный вариант остаётся доступен как fn.__wrapped__ (для вызовов внутри пула)."""
+    labels = (("fn", fn.__name__),)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(_db_executor, functools.partial(fn, *args, **kwargs))
+        except Exception:
+            metrics.inc("db_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("db_query_seconds", labels, time.perf_counter() - start)
+    return wrapper
+
+def db_close():
+    _db_executor.shutdown(wait=True)
+    with _db_conns_lock:
+        for conn in _db_conns:
+            conn.close()
+        _db_conns.clear()
+
+def db_ensure_column(conn: sqlite3.Connection, table: str, column: str, decl: str):
+    # Мини-миграция для уже существующих баз: добавить колонку, если её ещё нет
+    cols = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+@db_call
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
+    conn = db_connect()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")  # воркеры стартуют одновременно — миграции по очереди
         conn.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -59,138 +349,1127 @@ def init_db():
                 amount TEXT,
                 status TEXT,
                 payment_id TEXT,
-                created_at INTEGER
+                created_at INTEGER,
+                updated_at INTEGER,
+                confirmation_url TEXT
+            )
+        """)
+        db_ensure_column(conn, "orders", "updated_at", "INTEGER")
+        db_ensure_column(conn, "orders", "confirmation_url", "TEXT")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS reminders (
+                invoice_id TEXT PRIMARY KEY,
+                due_at INTEGER NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_due_at ON reminders (due_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_payment_id ON orders (payment_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS invite_links (
+                invite_link TEXT PRIMARY KEY,
+                invoice_id TEXT,
+                created_at INTEGER,
+                expire_at INTEGER,
+                used_at INTEGER
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_invite_links_invoice ON invite_links (invoice_id)")
+        init_sales_summary(conn)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        # Общая для воркеров память «уже видели»: update_id от Telegram, входы в группу
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS seen_keys (
+                key TEXT PRIMARY KEY,
+                seen_at INTEGER NOT NULL
             )
         """)
-        conn.commit()
 
+@db_call
+def db_enable_incremental_vacuum() -> bool:
+    # Существующая база: INCREMENTAL включается только вместе с VACUUM. Он держит базу целиком,
+    # поэтому делается разово и только в воркере-лидере, а не во всех воркерах на старте.
+    conn = db_connect()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+# Дни в отчётах — по московскому времени
+SALES_DAY_SQL = "date({col}, 'unixepoch', '+3 hours')"
+
+def init_sales_summary(conn: sqlite3.Connection):
+    # Сводка продаж по дням и пакетам; поддерживается триггерами в той же транзакции,
+    # что и сам заказ, так что отчёт не сканирует orders
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT NOT NULL,
+            plan_id TEXT NOT NULL,
+            orders INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0,
+            revenue_kop INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan_id)
+        )
+    """)
+    new_day = SALES_DAY_SQL.format(col="NEW.created_at")
+    # Заказы пишутся только обычным INSERT: INSERT OR REPLACE удаляет старую строку без триггера,
+    # и заказ посчитался бы в сводке дважды
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_sales_insert AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO sales_daily (day, plan_id, orders, paid, revenue_kop)
+            VALUES ({new_day}, COALESCE(NEW.plan_id, ''), 1,
+                    NEW.status = 'paid', CASE WHEN NEW.status = 'paid' THEN CAST(ROUND(NEW.amount * 100) AS INTEGER) ELSE 0 END)
+            ON CONFLICT(day, plan_id) DO UPDATE SET
+                orders = orders + 1,
+                paid = paid + excluded.paid,
+                revenue_kop = revenue_kop + excluded.revenue_kop;
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_orders_sales_paid AFTER UPDATE OF status ON orders
+        WHEN NEW.status = 'paid' AND OLD.status IS NOT 'paid'
+        BEGIN
+            UPDATE sales_daily SET
+                paid = paid + 1,
+                revenue_kop = revenue_kop + CAST(ROUND(NEW.amount * 100) AS INTEGER)
+            WHERE day = {new_day} AND plan_id = COALESCE(NEW.plan_id, '');
+        END
+    """)
+    # первый запуск на существующей базе — заполняем сводку из orders один раз
+    if conn.execute("SELECT 1 FROM sales_daily LIMIT 1").fetchone() is None:
+        day = SALES_DAY_SQL.format(col="created_at")
+        conn.execute(f"""
+            INSERT INTO sales_daily (day, plan_id, orders, paid, revenue_kop)
+            SELECT {day}, COALESCE(plan_id, ''), COUNT(*), SUM(status = 'paid'),
+                   SUM(CASE WHEN status = 'paid' THEN CAST(ROUND(amount * 100) AS INTEGER) ELSE 0 END)
+            FROM orders WHERE created_at IS NOT NULL
+            GROUP BY 1, 2
+        """)
+
+@db_call
+def db_acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    # Взять или продлить аренду: удаётся, если она наша или истекла
+    now = time.time()
+    conn = db_connect()
+    with conn:
+        cur = conn.execute("""
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        """, (name, owner, now + ttl, now))
+    return cur.rowcount == 1
+
+@db_call
+def db_claim_seen(key: str, ttl: int) -> bool:
+    # True — ключ новый (или виден последний раз больше ttl назад) и теперь наш
+    now = int(time.time())
+    conn = db_connect()
+    with conn:
+        cur = conn.execute("""
+            INSERT INTO seen_keys (key, seen_at) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_keys.seen_at < ?
+        """, (key, now, now - ttl))
+    return cur.rowcount == 1
+
+@db_call
+def db_forget_seen(key: str):
+    conn = db_connect()
+    with conn:
+        conn.execute("DELETE FROM seen_keys WHERE key = ?", (key,))
+
+@db_call
+def db_prune_seen(seen_before: int) -> int:
+    conn = db_connect()
+    with conn:
+        cur = conn.execute("DELETE FROM seen_keys WHERE seen_at < ?", (seen_before,))
+    return cur.rowcount
+
+@db_call
+def db_release_lease(name: str, owner: str):
+    conn = db_connect()
+    with conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+ORDER_FINAL_STATUSES = ("paid", "expired")
+
+@db_call
+def db_expire_pending_orders(created_before: int, limit: int) -> int:
+    conn = db_connect()
+    with conn:
+        cur = conn.execute("""
+            UPDATE orders SET status = 'expired', updated_at = ?
+            WHERE invoice_id IN (
+                SELECT invoice_id FROM orders WHERE status = 'pending' AND created_at < ? LIMIT ?
+            ) AND status = 'pending'
+        """, (int(time.time()), created_before, limit))
+    return cur.rowcount
+
+@db_call
+def db_archive_orders(created_before: int, limit: int, archive_dir: str) -> int:
+    """Переносит пачку старых заказов в финальном статусе в gzip-JSONL архив
+    (файл на месяц создания) и удаляет их из orders вместе с хвостами в reminders
+    и invite_links. Сначала файл пишется и fsync-ается, потом удаление — при падении
+    между ними строки могут попасть в архив дважды, но не потеряются."""
+    conn = db_connect()
+    marks = ", ".join("?" * len(ORDER_FINAL_STATUSES))
+    rows = conn.execute(f"""
+        SELECT invoice_id, user_id, plan_id, amount, status, payment_id, created_at, updated_at
+        FROM orders WHERE status IN ({marks}) AND created_at < ?
+        ORDER BY created_at LIMIT ?
+    """, (*ORDER_FINAL_STATUSES, created_before, limit)).fetchall()
+    if not rows:
+        return 0
+
+    keys = ("invoice_id", "user_id", "plan_id", "amount", "status", "payment_id", "created_at", "updated_at")
+    by_month = {}
+    for row in rows:
+        month = time.strftime("%Y-%m", time.gmtime(row[6] or 0))
+        by_month.setdefault(month, []).append(row)
+    os.makedirs(archive_dir, exist_ok=True)
+    for month, month_rows in by_month.items():
+        path = os.path.join(archive_dir, f"orders-{month}.jsonl.gz")
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as gz:  # каждая пачка — отдельный gzip member
+                for row in month_rows:
+                    gz.write(json.dumps(dict(zip(keys, row)), ensure_ascii=False).encode() + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+
+    ids = [row[0] for row in rows]
+    id_marks = ", ".join("?" * len(ids))
+    with conn:
+        conn.execute(f"DELETE FROM reminders WHERE invoice_id IN ({id_marks})", ids)
+        conn.execute(f"DELETE FROM invite_links WHERE invoice_id IN ({id_marks})", ids)
+        conn.execute(f"DELETE FROM orders WHERE invoice_id IN ({id_marks}) AND status IN ({marks})",
+                     (*ids, *ORDER_FINAL_STATUSES))
+    return len(rows)
+
+@db_call
+def db_delete_expired_invite_links(expired_before: int) -> int:
+    conn = db_connect()
+    with conn:
+        cur = conn.execute("DELETE FROM invite_links WHERE expire_at < ?", (expired_before,))
+    return cur.rowcount
+
+@db_call
+def db_incremental_vacuum(pages: int) -> int:
+    # Возвращает, сколько свободных страниц ещё осталось
+    conn = db_connect()
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+@db_call
 def db_get_all_users():
-    with sqlite3.connect(DB_FILE) as conn:
-        cur = conn.execute("SELECT user_id FROM users")
-        return [row[0] for row in cur.fetchall()]
+    cur = db_connect().execute("SELECT user_id FROM users")
+    return [row[0] for row in cur.fetchall()]
+
+@db_call
+def db_get_user_ids_after(after_user_id: int, limit: int):
+    # Keyset-пагинация по первичному ключу: каждая пачка — короткий индексный запрос
+    cur = db_connect().execute(
+        "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (after_user_id, limit)
+    )
+    return [row[0] for row in cur.fetchall()]
 
-def db_get_user(user_id: int):
-    with sqlite3.connect(DB_FILE) as conn:
-        cur = conn.execute("SELECT user_id, name, email, step, last_invoice_id FROM users WHERE user_id = ?", (user_id,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        return {"user_id": row[0], "name": row[1], "email": row[2], "step": row[3], "last_invoice_id": row[4]}
+async def db_iter_user_ids(chunk_size: int = 500):
+    after = -(2 ** 63)
+    while True:
+        chunk = await db_get_user_ids_after(after, chunk_size)
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1]
 
+@db_call
+def db_get_user(user_id: int):
+    cur = db_connect().execute("SELECT user_id, name, email, step, last_invoice_id FROM users WHERE user_id = ?", (user_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {"user_id": row[0], "name": row[1], "email": row[2], "step": row[3], "last_invoice_id": row[4]}
+
+USER_COLUMNS = ("name", "email", "step", "last_invoice_id")
+
+def _upsert_user(conn: sqlite3.Connection, user_id: int, fields: dict):
+    # Один INSERT ... ON CONFLICT: пишем только переданные колонки, без чтения строки заранее
+    unknown = set(fields) - set(USER_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown user columns: {', '.join(sorted(unknown))}")
+
+    cols = [c for c in USER_COLUMNS if c in fields]
+    values = {"user_id": user_id, **fields}
+    if cols:
+        updates = ", ".join(f"{c} = excluded.{c}" for c in cols)
+        conflict = f"DO UPDATE SET {updates}"
+    else:
+        conflict = "DO NOTHING"
+
+    conn.execute(f"""
+        INSERT INTO users (user_id{"".join(", " + c for c in cols)})
+        VALUES (:user_id{"".join(", :" + c for c in cols)})
+        ON CONFLICT(user_id) {conflict}
+    """, values)
+
+@db_call
 def db_upsert_user(user_id: int, **kwargs):
-    current = db_get_user(user_id) or {
-        "user_id": user_id,
-        "name": None,
-        "email": None,
-        "step": None,
-        "last_invoice_id": None
-    }
-    for key, value in kwargs.items():
-        current[key] = value
-
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("""
-            INSERT OR REPLACE INTO users (user_id, name, email, step, last_invoice_id)
-            VALUES (:user_id, :name, :email, :step, :last_invoice_id)
-        """, current)
-        conn.commit()  # ✅ ВАЖНО
-
+    conn = db_connect()
+    with conn:  # ✅ коммит при выходе из блока
+        _upsert_user(conn, user_id, kwargs)
+
+@db_call
+def db_upsert_users(batch: dict):
+    # batch: {user_id: {колонка: значение}} — все записи одним коммитом
+    conn = db_connect()
+    with conn:
+        for user_id, fields in batch.items():
+            _upsert_user(conn, user_id, fields)
+
+@db_call
 def db_create_order(invoice_id, user_id, plan_id, amount, status, payment_id):
-    with sqlite3.connect(DB_FILE) as conn:
+    conn = db_connect()
+    with conn:
         conn.execute(
-            "INSERT OR REPLACE INTO orders (invoice_id, user_id, plan_id, amount, status, payment_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            "INSERT INTO orders (invoice_id, user_id, plan_id, amount, status, payment_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
             (invoice_id, user_id, plan_id, str(amount), status, payment_id, int(time.time()))
         )
-        conn.commit()  # ✅ ВАЖНО
 
+@db_call
+def db_create_user_order(invoice_id, user_id, plan_id, amount, status, payment_id, remind_at=None,
+                         confirmation_url=None):
+    # Заказ, last_invoice_id пользователя и напоминание — в одной транзакции (один коммит)
+    conn = db_connect()
+    with conn:
+        conn.execute(
+            "INSERT INTO orders (invoice_id, user_id, plan_id, amount, status, payment_id, created_at, confirmation_url) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (invoice_id, user_id, plan_id, str(amount), status, payment_id, int(time.time()), confirmation_url)
+        )
+        conn.execute("""
+            INSERT INTO users (user_id, last_invoice_id) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET last_invoice_id = excluded.last_invoice_id
+        """, (user_id, invoice_id))
+        if remind_at is not None:
+            conn.execute("INSERT OR REPLACE INTO reminders (invoice_id, due_at) VALUES (?, ?)", (invoice_id, int(remind_at)))
+
+@db_call
+def db_get_due_reminders(until: int, limit: int):
+    cur = db_connect().execute(
+        "SELECT invoice_id, due_at FROM reminders WHERE due_at <= ? ORDER BY due_at LIMIT ?", (until, limit)
+    )
+    return cur.fetchall()
+
+@db_call
+def db_claim_reminders(invoice_ids: list):
+    # Забираем напоминания пачкой: удаляем их и одним запросом узнаём, какие заказы ещё pending
+    conn = db_connect()
+    marks = ", ".join("?" * len(invoice_ids))
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")  # SELECT и DELETE под одной блокировкой записи
+        cur = conn.execute(f"""
+            SELECT o.invoice_id, o.user_id FROM reminders r
+            JOIN orders o ON o.invoice_id = r.invoice_id
+            WHERE r.invoice_id IN ({marks}) AND o.status = 'pending'
+        """, invoice_ids)
+        rows = cur.fetchall()
+        conn.execute(f"DELETE FROM reminders WHERE invoice_id IN ({marks})", invoice_ids)
+    return rows
+
+@db_call
 def db_get_order(invoice_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
-        cur = conn.execute("SELECT invoice_id, user_id, plan_id, amount, status, payment_id, created_at FROM orders WHERE invoice_id = ?", (invoice_id,))
-        row = cur.fetchone()
+    cur = db_connect().execute("SELECT invoice_id, user_id, plan_id, amount, status, payment_id, created_at FROM orders WHERE invoice_id = ?", (invoice_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        "invoice_id": row[0],
+        "user_id": row[1],
+        "plan_id": row[2],
+        "amount": row[3],
+        "status": row[4],
+        "payment_id": row[5],
+        "created_at": row[6],
+    }
+
+@db_call
+def db_add_invite_link(invite_link: str, created_at: int, expire_at: int, invoice_id: str = None):
+    conn = db_connect()
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO invite_links (invite_link, invoice_id, created_at, expire_at) VALUES (?, ?, ?, ?)",
+            (invite_link, invoice_id, created_at, expire_at)
+        )
+
+@db_call
+def db_get_order_link(invoice_id: str, valid_until: int):
+    # Неиспользованная ссылка заказа, которая проживёт ещё хотя бы до valid_until
+    cur = db_connect().execute("""
+        SELECT invite_link FROM invite_links
+        WHERE invoice_id = ? AND used_at IS NULL AND expire_at > ?
+        ORDER BY expire_at DESC LIMIT 1
+    """, (invoice_id, valid_until))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+@db_call
+def db_take_pool_link(invoice_id: str, created_after: int, valid_until: int):
+    # Забираем свободную ссылку из пула за заказом; UPDATE условный, чтобы два потока
+    # не выдали одну и ту же ссылку
+    conn = db_connect()
+    while True:
+        row = conn.execute("""
+            SELECT invite_link FROM invite_links
+            WHERE invoice_id IS NULL AND created_at > ? AND expire_at > ?
+            ORDER BY created_at DESC LIMIT 1
+        """, (created_after, valid_until)).fetchone()
         if not row:
             return None
-        return {
-            "invoice_id": row[0],
-            "user_id": row[1],
-            "plan_id": row[2],
-            "amount": row[3],
-            "status": row[4],
-            "payment_id": row[5],
-            "created_at": row[6],
-        }
+        with conn:
+            cur = conn.execute(
+                "UPDATE invite_links SET invoice_id = ? WHERE invite_link = ? AND invoice_id IS NULL",
+                (invoice_id, row[0])
+            )
+        if cur.rowcount:
+            return row[0]
+
+@db_call
+def db_count_pool_links(created_after: int, valid_until: int) -> int:
+    cur = db_connect().execute(
+        "SELECT COUNT(*) FROM invite_links WHERE invoice_id IS NULL AND created_at > ? AND expire_at > ?",
+        (created_after, valid_until)
+    )
+    return cur.fetchone()[0]
 
+@db_call
+def db_mark_invite_used(invite_link: str):
+    conn = db_connect()
+    with conn:
+        conn.execute(
+            "UPDATE invite_links SET used_at = ? WHERE invite_link = ? AND used_at IS NULL",
+            (int(time.time()), invite_link)
+        )
+
+@db_call
+def db_get_stale_pool_links(created_before: int, now: int) -> list:
+    # Невыданные ссылки старше допустимого возраста, которые ещё живы в Telegram
+    cur = db_connect().execute(
+        "SELECT invite_link FROM invite_links WHERE invoice_id IS NULL AND created_at <= ? AND expire_at > ?",
+        (created_before, now)
+    )
+    return [row[0] for row in cur.fetchall()]
+
+@db_call
+def db_delete_pool_link(invite_link: str):
+    conn = db_connect()
+    with conn:
+        conn.execute("DELETE FROM invite_links WHERE invite_link = ? AND invoice_id IS NULL", (invite_link,))
+
+@db_call
+def db_find_open_order(user_id: int, plan_id: str, created_after: int):
+    # Последний неоплаченный заказ пользователя на этот пакет, по которому ещё можно платить
+    cur = db_connect().execute("""
+        SELECT invoice_id, payment_id, confirmation_url FROM orders
+        WHERE user_id = ? AND plan_id = ? AND status = 'pending' AND created_at >= ?
+              AND payment_id IS NOT NULL AND confirmation_url IS NOT NULL
+        ORDER BY created_at DESC LIMIT 1
+    """, (user_id, plan_id, created_after))
+    row = cur.fetchone()
+    return {"invoice_id": row[0], "payment_id": row[1], "confirmation_url": row[2]} if row else None
+
+@db_call
+def db_get_order_by_payment(payment_id: str):
+    cur = db_connect().execute("SELECT invoice_id FROM orders WHERE payment_id = ?", (payment_id,))
+    row = cur.fetchone()
+    return db_get_order.__wrapped__(row[0]) if row else None
+
+@db_call
 def db_update_order_status(invoice_id: str, status: str):
-    with sqlite3.connect(DB_FILE) as conn:
+    conn = db_connect()
+    with conn:
         conn.execute("UPDATE orders SET status = ? WHERE invoice_id = ?", (status, invoice_id))
-        conn.commit()  # ✅ ВАЖНО
 
+@db_call
+def db_get_pending_orders(created_after: int, limit: int):
+    cur = db_connect().execute("""
+        SELECT invoice_id, payment_id, created_at FROM orders
+        WHERE status = 'pending' AND created_at >= ?
+        ORDER BY created_at LIMIT ?
+    """, (created_after, limit))
+    return cur.fetchall()
+
+@db_call
+def db_get_sales(day_from: str, day_to: str):
+    cur = db_connect().execute("""
+        SELECT day, plan_id, orders, paid, revenue_kop FROM sales_daily
+        WHERE day BETWEEN ? AND ? ORDER BY day, plan_id
+    """, (day_from, day_to))
+    return cur.fetchall()
+
+@db_call
+def db_get_orders_page(created_from: int, created_to: int, after: tuple, limit: int):
+    # Keyset-пагинация по (created_at, invoice_id) через idx_orders_created_at
+    cur = db_connect().execute("""
+        SELECT invoice_id, user_id, plan_id, amount, status, payment_id, created_at FROM orders
+        WHERE created_at >= ? AND created_at < ? AND (created_at, invoice_id) > (?, ?)
+        ORDER BY created_at, invoice_id LIMIT ?
+    """, (created_from, created_to, after[0], after[1], limit))
+    return cur.fetchall()
+
+@db_call
+def db_transition_order(invoice_id: str, from_status: str, to_status: str) -> bool:
+    # Compare-and-set: True только у того, кто реально перевёл заказ из from_status
+    conn = db_connect()
+    with conn:
+        cur = conn.execute(
+            "UPDATE orders SET status = ?, updated_at = ? WHERE invoice_id = ? AND status = ?",
+            (to_status, int(time.time()), invoice_id, from_status)
+        )
+    return cur.rowcount == 1
+
+@db_call
+def db_claim_stuck_orders(status: str, updated_before: int, limit: int = 100):
+    # Перехватываем зависшие заказы: обновляем updated_at условно, чтобы каждый забрал кто-то один
+    conn = db_connect()
+    rows = conn.execute(
+        "SELECT invoice_id, updated_at FROM orders WHERE status = ? AND COALESCE(updated_at, 0) < ? LIMIT ?",
+        (status, updated_before, limit)
+    ).fetchall()
+    claimed = []
+    now = int(time.time())
+    with conn:
+        for invoice_id, updated_at in rows:
+            cur = conn.execute(
+                "UPDATE orders SET updated_at = ? WHERE invoice_id = ? AND status = ? AND updated_at IS ?",
+                (now, invoice_id, status, updated_at)
+            )
+            if cur.rowcount:
+                claimed.append(invoice_id)
+    return claimed
+
+@db_call
 def db_set_user_last_invoice(user_id: int, invoice_id: str):
-    with sqlite3.connect(DB_FILE) as conn:
+    conn = db_connect()
+    with conn:
         conn.execute("UPDATE users SET last_invoice_id = ? WHERE user_id = ?", (invoice_id, user_id))
-        conn.commit()  # ✅ ВАЖНО
+
+# ---------------- Фоновые задачи ----------------
+class PeriodicTask:
+    """Запускает корутину fn каждые interval секунд; ошибки логирует и продолжает."""
+
+    def __init__(self, name: str, interval: float, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self._task = None
+        self.runs = 0
+        self.failures = 0
+
+    async def _run(self):
+        while True:
+            try:
+                await self.fn()
+                self.runs += 1
+            except Exception as e:
+                self.failures += 1
+                metrics.swallowed(self.name)
+                log_event(f"{self.name.upper()}_ERROR", logging.ERROR, error=str(e))
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+
+
+class Lease:
+    """Аренда name в таблице leases: продлевается каждые ttl/3 секунд. Пока аренда наша,
+    запущена задача (on_acquire); потеряли — останавливаем (on_release). Так каждая
+    фоновая задача работает ровно в одном воркере, а при его падении через ttl её
+    подхватывает другой."""
+
+    def __init__(self, name: str, on_acquire, on_release, ttl: float = LEASE_TTL):
+        self.name = name
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.ttl = ttl
+        self.held = False
+        self._task = None
+
+    @staticmethod
+    async def _call(fn):
+        res = fn()
+        if inspect.isawaitable(res):
+            await res
+
+    async def _run(self):
+        while True:
+            try:
+                held = await db_acquire_lease(self.name, WORKER_ID, self.ttl)
+                if held and not self.held:
+                    await self._call(self.on_acquire)
+                    self.held = True  # не удалось запустить — попробуем на следующем продлении
+                elif not held and self.held:
+                    self.held = False
+                    await self._call(self.on_release)
+            except Exception as e:
+                metrics.swallowed(f"lease_{self.name}")
+                log_event("LEASE_ERROR", logging.ERROR, lease=self.name, error=str(e))
+            metrics.set("bot_lease_held", (("name", self.name),), int(self.held))
+            await asyncio.sleep(self.ttl / 3)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.held:
+            self.held = False
+            await self._call(self.on_release)
+            await db_release_lease(self.name, WORKER_ID)
+
+# ---------------- User cache ----------------
+# При нескольких воркерах апдейты одного пользователя попадают в разные процессы, и локальный
+# кэш устаревал бы — по умолчанию он тогда выключен (USER_CACHE_SIZE=0)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000" if WEB_CONCURRENCY == 1 else "0"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+USER_CACHE_MODE = os.getenv("USER_CACHE_MODE", "write-through")  # write-through | write-behind
+USER_CACHE_FLUSH_INTERVAL = float(os.getenv("USER_CACHE_FLUSH_INTERVAL", "1"))
+
+
+class UserCache:
+    """LRU/TTL-кэш записей users перед db_get_user/db_upsert_user.
+
+    write-through — каждое изменение сразу пишется в SQLite;
+    write-behind — изменения копятся в памяти и сбрасываются пачкой раз в flush_interval
+    (и при остановке приложения)."""
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL,
+                 mode: str = USER_CACHE_MODE, flush_interval: float = USER_CACHE_FLUSH_INTERVAL):
+        if mode not in ("write-through", "write-behind"):
+            raise ValueError(f"Unknown USER_CACHE_MODE: {mode}")
+        if mode == "write-behind" and WEB_CONCURRENCY > 1:
+            raise ValueError("USER_CACHE_MODE=write-behind is not supported with several workers")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.write_behind = mode == "write-behind"
+        self.flush_interval = flush_interval
+        self._items = OrderedDict()  # user_id -> (expires_at, record)
+        self._dirty = {}             # user_id -> ещё не записанные колонки (write-behind)
+        self._flushing = {}          # пачка, которую сейчас пишет flush
+        self._writes = 0
+        self._flush_task = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+
+    def _store(self, user_id: int, record: dict):
+        if self.maxsize <= 0:
+            return
+        self._items[user_id] = (time.monotonic() + self.ttl, record)
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, user_id: int):
+        item = self._items.get(user_id)
+        if item and item[0] > time.monotonic():
+            self._items.move_to_end(user_id)
+            self.hits += 1
+            return dict(item[1])
+
+        self.misses += 1
+        writes_before = self._writes
+        record = await db_get_user(user_id)
+        pending = self._dirty.get(user_id)
+        if pending:
+            record = {**(record or {"user_id": user_id, **dict.fromkeys(USER_COLUMNS)}), **pending}
+        if record is None:
+            self._items.pop(user_id, None)
+            return None
+        # если пока мы читали, кто-то писал — не кладём в кэш возможно устаревшую строку
+        if self._writes == writes_before:
+            self._store(user_id, record)
+        return dict(record)
+
+    def patch(self, user_id: int, **fields):
+        """Обновить закэшированную запись без записи в БД (когда БД уже обновлена)."""
+        if self.write_behind:
+            # более старые несохранённые значения тех же колонок не должны затереть то, что уже в БД
+            dirty = self._dirty.get(user_id)
+            if dirty:
+                for key in fields:
+                    dirty.pop(key, None)
+                if not dirty:
+                    del self._dirty[user_id]
+            if user_id in self._flushing:
+                # пачка уже пишется и может закоммититься позже нас — после неё запишем ещё раз
+                self._dirty[user_id] = {**self._dirty.get(user_id, {}), **fields}
+        self._cache_fields(user_id, fields)
+
+    def _cache_fields(self, user_id: int, fields: dict):
+        self._writes += 1
+        item = self._items.get(user_id)
+        if item:
+            self._store(user_id, {**item[1], **fields})
+        elif set(fields) >= set(USER_COLUMNS):
+            self._store(user_id, {"user_id": user_id, **fields})
+
+    async def update(self, user_id: int, **fields):
+        unknown = set(fields) - set(USER_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown user columns: {', '.join(sorted(unknown))}")
+        if self.write_behind:
+            self._dirty[user_id] = {**self._dirty.get(user_id, {}), **fields}
+        else:
+            await db_upsert_user(user_id, **fields)
+        self._cache_fields(user_id, fields)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        self._flushing = batch
+        try:
+            await db_upsert_users(batch)
+            self.flushes += 1
+        except Exception:
+            # вернуть несохранённое, не затирая более свежие изменения
+            for user_id, fields in batch.items():
+                self._dirty[user_id] = {**fields, **self._dirty.get(user_id, {})}
+            raise
+        finally:
+            self._flushing = {}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                metrics.swallowed("user_cache_flush")
+                log_event("USER_CACHE_FLUSH_ERROR", logging.ERROR, error=str(e))
+
+    def start(self):
+        if self.write_behind and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._items),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "flushes": self.flushes,
+        }
+
+
+user_cache = UserCache()
 
 # ---------------- Пакеты ----------------
+# title и description берутся из каталога текстов (plan_<id>_title / plan_<id>_description)
 PLANS = {
-    "test": {
-        "title": "🧪 Тест за 1 ₽",
-        "amount": Decimal("1.00"),
-        "description": 'ТЕСТ: материалы "Самодисциплина без стресса"',
-    },
-    "basic": {
-        "title": "Войти в группу",
-        "amount": Decimal("2400.00"),
-        "description": 'Доступ к материалам "Самодисциплина без стресса"',
-    },
-    "pro": {
-        "title": "С сопровождением",
-        "amount": Decimal("5400.00"),
-        "description": 'Доступ к материалам "Самодисциплина без стресса" с сопровождением',
-    },
+    "test": {"amount": Decimal("1.00")},
+    "basic": {"amount": Decimal("2400.00")},
+    "pro": {"amount": Decimal("5400.00")},
 }
 
-bot = Bot(BOT_TOKEN)
+# Свой Bot API сервер (telegram-bot-api или заглушка из bench.py), по умолчанию — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    bot = Bot(BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(BOT_TOKEN)
 dp = Dispatcher()
 app = FastAPI()
 
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время работы каждого aiogram-хендлера (метка — имя функции)."""
+
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        labels = (("handler", getattr(h.callback, "__name__", "unknown") if h else "unknown"),)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", labels, time.perf_counter() - start)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Время каждого вызова Bot API (метка — метод: SendMessage, CreateChatInviteLink, ...)."""
+
+    async def __call__(self, make_request, bot, method):
+        labels = (("method", type(method).__name__),)
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            metrics.inc("telegram_api_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("telegram_api_seconds", labels, time.perf_counter() - start)
+
+
+for _observer in (dp.message, dp.callback_query, dp.chat_member):
+    _observer.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(BotApiMetricsMiddleware())
+
+# ---------------- Тексты ----------------
+# Каталог сообщений: язык -> ключ -> шаблон ($name). Постоянные подстановки (юзернеймы,
+# секретное слово) вшиваются один раз при загрузке, в хендлерах остаётся только динамика.
+# Новый язык — ещё один словарь; отсутствующие в нём ключи берутся из "ru".
+BOT_LANG = os.getenv("BOT_LANG", "ru")
+
+TEXTS = {
+    "ru": {
+        "plan_test_title": "🧪 Тест за 1 ₽",
+        "plan_test_description": 'ТЕСТ: материалы "Самодисциплина без стресса"',
+        "plan_basic_title": "Войти в группу",
+        "plan_basic_description": 'Доступ к материалам "Самодисциплина без стресса"',
+        "plan_pro_title": "С сопровождением",
+        "plan_pro_description": 'Доступ к материалам "Самодисциплина без стресса" с сопровождением',
+        "fallback_name": "друг",
+        "greeting_name": "Друг",
+        "start_known": "Привет, $name! 🙂\nВыбирай пакет:",
+        "start_new": "Привет! 🙂 Я помогу оформить доступ в закрытую группу.\n\nКак тебя зовут?",
+        "flow_restart": "Давай начнём сначала — нажми /start 🙂",
+        "flow_bad_name": "Напиши имя чуть понятнее 🙂",
+        "flow_ask_email": "Приятно познакомиться, $name! 😊 Теперь укажи email для чека:",
+        "flow_bad_email": "Похоже, email с ошибкой. Попробуй ещё раз 🙂",
+        "flow_done": "$name, готово ✅\nВыбирай пакет:",
+        "flow_use_buttons": "Выбирай действие кнопками ниже 🙂",
+        "btn_choose_plan": "✅ Выбрать пакет",
+        "btn_support": "❓ Поддержка",
+        "btn_back": "⬅️ Назад",
+        "btn_plan": "$title — $amount ₽",
+        "btn_pay": "💳 Оплатить",
+        "btn_check": "✅ Я оплатил — проверить",
+        "btn_write_admin": "📩 Написать админу",
+        "btn_resend_link": "🔁 Получить ссылку ещё раз",
+        "access_granted": (
+            "Оплата подтверждена ✅\n\n"
+            "Ура, $name! 🎉\n"
+            "🆔 Номер заказа: `$inv_id`\n\n"
+            "⬇️ **ПЕРЕШЛИТЕ ЭТО СООБЩЕНИЕ РЕБЕНКУ** ⬇️\n\n"
+            "Вот персональная ссылка для входа в закрытую группу.\n"
+            "Ссылка одноразовая и действует 24 часа.\n\n"
+            "$link\n"
+        ),
+        "access_expert_note": (
+            "\nПакет включает сопровождение.\n"
+            "Напиши эксперту: @$expert\n"
+            "Секретное слово: `$secret_word`\n"
+            "И номер заказа: `$inv_id`\n"
+        ),
+        "payment": (
+            "Пакет: $title\n"
+            "Сумма: $amount ₽\n\n"
+            "Нажмите кнопку ниже, оплатите, и я пришлю ссылку ✅\n\n"
+            "Если оплатили, а ссылка не пришла — нажмите «✅ Я оплатил — проверить»."
+        ),
+        "resend_link": (
+            "Вот ваша персональная ссылка для входа в закрытую группу.\n"
+            "Ссылка одноразовая и действует 24 часа.\n\n"
+            "Если вы покупали доступ для ребёнка, пожалуйста, не входите сами — просто перешлите ссылку ребёнку:\n"
+            "$link"
+        ),
+        "unknown_plan": "Неизвестный пакет",
+        "need_onboarding": "Нажми /start и введи имя + email 🙂",
+        "already_paid": "Этот пакет уже оплачен ✅",
+        "payment_bad_response": "Проблема с оплатой. Напишите в поддержку.",
+        "payment_create_error": "Ошибка связи с платежной системой.",
+        "payment_in_progress": "Платёж ещё создаётся — нажмите на пакет ещё раз через минуту 🙂",
+        "order_not_found": "Заказ не найден.",
+        "payment_confirmed": "Оплата подтверждена ✅",
+        "payment_status": "Пока статус: $status. Если вы только что оплатили — подождите минуту 🙂",
+        "payment_check_error": "Не получилось проверить оплату. Попробуйте ещё раз.",
+        "return_page": "Спасибо! Если оплата прошла, бот пришлёт ссылку в течение минуты.",
+        "no_order": "Не вижу у вас заказа. Нажмите «Выбрать пакет».",
+        "link_after_payment": "Ссылка появится после успешной оплаты 🙂",
+        "link_resent": "Отправил ✅",
+        "reminder": "Похоже, вы не завершили оплату 🙂\nНужна помощь? Напишите @$admin",
+        "support": "Поддержка: @$admin",
+        "menu": "Меню:",
+        "plans": "Доступные пакеты:",
+        "welcome": (
+            "Добро пожаловать в группу, $names! 👋\n\n"
+            "Изучи правила в закреплённом сообщении.\n"
+            "Если у тебя пакет с сопровождением — напиши эксперту."
+        ),
+        "welcome_more": "$shown и ещё $more",
+        "test_link": "Тест генерации ссылки: $link",
+        "broadcast_usage": "Напиши: /broadcast <текст>\nили ответь командой /broadcast на сообщение для рассылки.",
+        "broadcast_started": "Рассылка запущена…",
+        "broadcast_running": "Рассылка идёт…",
+        "broadcast_done": "Рассылка завершена ✅",
+        "broadcast_progress": "$head\nОбработано: $total\nДоставлено: $sent\nЗаблокировали бота: $blocked\nОшибок: $failed",
+    },
+}
+
+_TEXT_CONSTANTS = {"admin": ADMIN_USERNAME, "expert": EXPERT_USERNAME, "secret_word": SECRET_WORD}
+
+
+def _compile_texts(lang: str) -> dict:
+    """Шаблоны языка lang (с фолбэком на ru): готовая строка, если подставлять больше нечего, иначе Template."""
+    compiled = {}
+    for key, raw in {**TEXTS["ru"], **TEXTS.get(lang, {})}.items():
+        tpl = Template(Template(raw).safe_substitute(_TEXT_CONSTANTS))
+        compiled[key] = tpl if tpl.get_identifiers() else tpl.template
+    return compiled
+
+
+_texts = _compile_texts(BOT_LANG)
+
+
+def t(key: str, **fields) -> str:
+    tpl = _texts[key]
+    return tpl.substitute(fields) if fields else tpl
+
+
+for _pid, _plan in PLANS.items():
+    _plan["title"] = t(f"plan_{_pid}_title")
+    _plan["description"] = t(f"plan_{_pid}_description")
+
 # ---------------- Клавиатуры ----------------
-def kb_main():
+# Статичные клавиатуры собираются один раз и отдаются всем апдейтам одним и тем же объектом —
+# не изменяйте их в хендлерах. Для kb_pay заранее собран «хвост» кнопок под каждый пакет,
+# на апдейт создаются только две кнопки с url оплаты и номером заказа.
+HIDDEN_PLANS = {"test"}  # ✅ скрываем тестовый пакет (не удаляя из кода)
+
+
+def _button(text_key: str, **kwargs) -> InlineKeyboardButton:
+    return InlineKeyboardButton(text=t(text_key), **kwargs)
+
+
+def _build_kb_main() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
-    kb.button(text="✅ Выбрать пакет", callback_data="choose_plan")
-    kb.button(text="❓ Поддержка", callback_data="support")
+    kb.button(text=t("btn_choose_plan"), callback_data="choose_plan")
+    kb.button(text=t("btn_support"), callback_data="support")
     kb.adjust(1)
     return kb.as_markup()
 
-def kb_plans():
+
+def _build_kb_plans() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     for pid, p in PLANS.items():
-        if pid == "test":
-            continue  # ✅ скрываем тестовый пакет (не удаляя из кода)
-        kb.button(text=f"{p['title']} — {p['amount']} ₽", callback_data=f"plan:{pid}")
-    kb.button(text="⬅️ Назад", callback_data="back")
+        if pid in HIDDEN_PLANS:
+            continue
+        kb.button(text=t("btn_plan", title=p["title"], amount=p["amount"]), callback_data=f"plan:{pid}")
+    kb.button(text=t("btn_back"), callback_data="back")
     kb.adjust(1)
     return kb.as_markup()
 
-def kb_pay(url: str, inv_id: str, plan_id: str):
-    kb = InlineKeyboardBuilder()
-    kb.button(text="💳 Оплатить", url=url)
-    kb.button(text="✅ Я оплатил — проверить", callback_data=f"check:{inv_id}")
 
+def _build_kb_pay_tail(plan_id: str) -> list:
+    rows = []
     if plan_id == "pro":
-        kb.button(text="📩 Написать админу", url=f"https://t.me/{ADMIN_USERNAME}")
+        rows.append([_button("btn_write_admin", url=f"https://t.me/{ADMIN_USERNAME}")])
+    rows.append([_button("btn_resend_link", callback_data="resend_link")])
+    rows.append([_button("btn_back", callback_data="choose_plan")])
+    return rows
 
-    kb.button(text="🔁 Получить ссылку ещё раз", callback_data="resend_link")
-    kb.button(text="⬅️ Назад", callback_data="choose_plan")
-    kb.adjust(1)
-    return kb.as_markup()
 
-# ---------------- YooKassa helpers ----------------
-def yk_auth():
-    return (YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
+_KB_MAIN = _build_kb_main()
+_KB_PLANS = _build_kb_plans()
+_KB_PAY_TAILS = {pid: _build_kb_pay_tail(pid) for pid in PLANS}
+_BTN_PAY_TEXT = t("btn_pay")
+_BTN_CHECK_TEXT = t("btn_check")
+
+
+def kb_main():
+    return _KB_MAIN
 
-def yk_create_payment(amount: Decimal, description: str, email: str, invoice_id: str) -> dict:
-    url = "https://api.yookassa.ru/v3/payments"
+def kb_plans():
+    return _KB_PLANS
+
+def kb_pay(url: str, inv_id: str, plan_id: str):
+    tail = _KB_PAY_TAILS.get(plan_id) or _build_kb_pay_tail(plan_id)
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=_BTN_PAY_TEXT, url=url)],
+        [InlineKeyboardButton(text=_BTN_CHECK_TEXT, callback_data=f"check:{inv_id}")],
+        *tail,
+    ])
+
+# ---------------- YooKassa client ----------------
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3").rstrip("/")
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "10"))
+YOOKASSA_CONNECT_TIMEOUT = float(os.getenv("YOOKASSA_CONNECT_TIMEOUT", "3"))
+YOOKASSA_MAX_CONCURRENCY = int(os.getenv("YOOKASSA_MAX_CONCURRENCY", "20"))
+YOOKASSA_RETRIES = int(os.getenv("YOOKASSA_RETRIES", "2"))
+YOOKASSA_RETRY_BACKOFF = float(os.getenv("YOOKASSA_RETRY_BACKOFF", "0.3"))
+YOOKASSA_DEADLINE = float(os.getenv("YOOKASSA_DEADLINE", "15"))  # общий бюджет вызова с повторами
+YOOKASSA_MIN_ATTEMPT = float(os.getenv("YOOKASSA_MIN_ATTEMPT", "1"))  # меньше осталось от бюджета — не повторяем
+YOOKASSA_BREAKER_THRESHOLD = int(os.getenv("YOOKASSA_BREAKER_THRESHOLD", "5"))
+YOOKASSA_BREAKER_COOLDOWN = float(os.getenv("YOOKASSA_BREAKER_COOLDOWN", "30"))
+YOOKASSA_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class YooKassaUnavailable(RuntimeError):
+    """Circuit breaker открыт: YooKassa недавно отвечала ошибками, не ждём её."""
+
+
+class YooKassaClient:
+    """Асинхронный клиент YooKassa: одна aiohttp-сессия на всё время жизни приложения
+    (keep-alive пул соединений), таймауты на каждый вызов и лимит одновременных запросов.
+    Сетевые ошибки, 429 и 5xx повторяются с экспоненциальной задержкой и jitter (POST
+    безопасно повторять — Idempotence-Key детерминированный); каждая попытка получает не больше
+    времени, чем осталось до deadline. После threshold неудач
+    подряд breaker открывается на cooldown секунд и вызовы сразу падают с
+    YooKassaUnavailable; затем пропускается один пробный запрос."""
+
+    def __init__(self, shop_id: str, secret_key: str, base_url: str = YOOKASSA_API_URL,
+                 timeout: float = YOOKASSA_TIMEOUT, connect_timeout: float = YOOKASSA_CONNECT_TIMEOUT,
+                 max_concurrency: int = YOOKASSA_MAX_CONCURRENCY, retries: int = YOOKASSA_RETRIES,
+                 backoff: float = YOOKASSA_RETRY_BACKOFF, deadline: float = YOOKASSA_DEADLINE,
+                 breaker_threshold: int = YOOKASSA_BREAKER_THRESHOLD,
+                 breaker_cooldown: float = YOOKASSA_BREAKER_COOLDOWN):
+        self.base_url = base_url
+        self._auth = aiohttp.BasicAuth(shop_id, secret_key)
+        self._timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self._max_concurrency = max_concurrency
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._session = None
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    def _before_call(self):
+        now = time.monotonic()
+        if self._failures < self.breaker_threshold:
+            return
+        if now < self._open_until or self._probing:
+            metrics.inc("yookassa_breaker_rejections_total")
+            raise YooKassaUnavailable("YooKassa circuit breaker is open")
+        self._probing = True  # half-open: пропускаем один пробный запрос
+
+    def _record(self, ok: bool):
+        self._probing = False
+        if ok:
+            self._failures = 0
+            return
+        self._failures += 1
+        if self._failures >= self.breaker_threshold:
+            self._open_until = time.monotonic() + self.breaker_cooldown
+
+    @property
+    def breaker_state(self) -> str:
+        if self._failures < self.breaker_threshold:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until else "half-open"
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                auth=self._auth,
+                timeout=self._timeout,
+                connector=connector,
+                raise_for_status=False,
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _send(self, session, method: str, url: str, kwargs: dict):
+        async with self._sem:
+            async with session.request(method, url, **kwargs) as r:
+                return r.status, await r.text()
+
+    async def request(self, method: str, path: str, *, json=None, params=None, headers=None,
+                      timeout: float | None = None):
+        self._before_call()
+        try:
+            return await self._attempts(method, path, json, params, headers, timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise  # уже учтено в _attempts
+        except Exception:
+            self._record(False)
+            raise
+        finally:
+            self._probing = False  # пробный запрос отменён или упал — следующий вызов снова может пробовать
+
+    async def _attempts(self, method: str, path: str, json, params, headers, timeout: float | None):
+        session = await self.start()
+        kwargs = {"json": json, "params": params, "headers": headers}
+        per_attempt = timeout if timeout is not None else self._timeout.total
+        url = f"{self.base_url}{path}"
+        started = time.monotonic()
+
+        attempt = 0
+        while True:
+            left = self.deadline - (time.monotonic() - started)
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=min(per_attempt, left),
+                                                      sock_connect=self._timeout.sock_connect)
+            try:
+                status, text = await self._send(session, method, url, kwargs)
+                error = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, text, error = None, None, e
+
+            if error is None and status not in YOOKASSA_RETRY_STATUSES:
+                self._record(True)
+                return status, text
+
+            delay = random.uniform(0, self.backoff * 2 ** attempt)  # full jitter
+            left = self.deadline - (time.monotonic() - started) - delay
+            if attempt >= self.retries or left < YOOKASSA_MIN_ATTEMPT:
+                self._record(False)
+                if error is not None:
+                    raise error
+                return status, text
+            attempt += 1
+            metrics.inc("yookassa_retries_total")
+            await asyncio.sleep(delay)
+
+
+yookassa = YooKassaClient(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
+
+def yk_idempotence_key(invoice_id: str) -> str:
+    # Один и тот же заказ -> один и тот же ключ: повтор запроса не создаст второй платёж
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"yookassa:create:{YOOKASSA_SHOP_ID}:{invoice_id}"))
+
+@timed("yookassa_request_seconds", "op", "create_payment")
+async def yk_create_payment(amount: Decimal, description: str, email: str, invoice_id: str) -> dict:
     headers = {
-        "Idempotence-Key": str(uuid.uuid4()),
+        "Idempotence-Key": yk_idempotence_key(invoice_id),
         "Content-Type": "application/json",
     }
 
@@ -218,64 +1497,744 @@ def yk_create_payment(amount: Decimal, description: str, email: str, invoice_id:
         },
     }
 
-    r = requests.post(url, auth=yk_auth(), headers=headers, json=payload, timeout=20)
-    if r.status_code not in (200, 201):
-        raise RuntimeError(f"YooKassa create payment error: {r.status_code} {r.text}")
-    return r.json()
+    status, text = await yookassa.request("POST", "/payments", json=payload, headers=headers)
+    if status not in (200, 201):
+        raise RuntimeError(f"YooKassa create payment error: {status} {text}")
+    return json.loads(text)
+
+@timed("yookassa_request_seconds", "op", "get_payment")
+async def yk_get_payment(payment_id: str) -> dict:
+    status, text = await yookassa.request("GET", f"/payments/{payment_id}")
+    if status != 200:
+        raise RuntimeError(f"YooKassa get payment error: {status} {text}")
+    return json.loads(text)
+
+@timed("yookassa_request_seconds", "op", "list_payments")
+async def yk_list_payments(params: dict) -> dict:
+    status, text = await yookassa.request("GET", "/payments", params=params)
+    if status != 200:
+        raise RuntimeError(f"YooKassa list payments error: {status} {text}")
+    return json.loads(text)
+
+# Адреса, с которых YooKassa шлёт уведомления: https://yookassa.ru/developers/using-api/webhooks
+YOOKASSA_NOTIFY_NETWORKS = [
+    ipaddress.ip_network(n) for n in os.getenv(
+        "YOOKASSA_NOTIFY_NETWORKS",
+        "185.71.76.0/27,185.71.77.0/27,77.75.153.0/25,77.75.156.11/32,77.75.156.35/32,77.75.154.128/25,2a02:5180::/32",
+    ).split(",") if n.strip()
+]
+# Доверять объекту платежа из уведомления без запроса в API — только по явному YOOKASSA_TRUST_WEBHOOKS=1.
+# Адрес отправителя — r.client.host (uvicorn подставляет его из X-Forwarded-For сам, если прокси
+# указан в --forwarded-allow-ips). X-Forwarded-For читаем только когда прямой пир — наш прокси
+# из YOOKASSA_TRUSTED_PROXIES; иначе заголовок может прислать кто угодно.
+YOOKASSA_TRUST_WEBHOOKS = os.getenv("YOOKASSA_TRUST_WEBHOOKS", "0") == "1"
+YOOKASSA_TRUSTED_PROXIES = [
+    ipaddress.ip_network(n.strip()) for n in os.getenv("YOOKASSA_TRUSTED_PROXIES", "").split(",") if n.strip()
+]
+YOOKASSA_STATUS_TTL = float(os.getenv("YOOKASSA_STATUS_TTL", "3"))
+YOOKASSA_FINAL_STATUS_TTL = float(os.getenv("YOOKASSA_FINAL_STATUS_TTL", "300"))
+YOOKASSA_FINAL_STATUSES = ("succeeded", "canceled")
+
+def _ip_in(host, networks) -> bool:
+    try:
+        addr = ipaddress.ip_address(host)
+    except (TypeError, ValueError):
+        return False
+    return any(addr in net for net in networks)
+
+def yk_is_trusted_source(r: Request) -> bool:
+    if not YOOKASSA_TRUST_WEBHOOKS:
+        return False
+    host = r.client.host if r.client else None
+    forwarded = r.headers.get("x-forwarded-for")
+    if forwarded and _ip_in(host, YOOKASSA_TRUSTED_PROXIES):
+        # последний адрес дописал наш прокси — это тот, кто к нему подключился
+        host = forwarded.split(",")[-1].strip()
+    return _ip_in(host, YOOKASSA_NOTIFY_NETWORKS)
+
+
+class PaymentStatusCache:
+    """Короткоживущий кэш платежей по payment_id + single-flight: параллельные проверки
+    одного платежа ждут один общий запрос к YooKassa."""
+
+    def __init__(self, ttl: float = YOOKASSA_STATUS_TTL, final_ttl: float = YOOKASSA_FINAL_STATUS_TTL,
+                 maxsize: int = 10000):
+        self.ttl = ttl
+        self.final_ttl = final_ttl
+        self.maxsize = maxsize
+        self._items = {}     # payment_id -> (expires_at, payment)
+        self._inflight = {}  # payment_id -> Future
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def put(self, payment: dict):
+        payment_id = payment.get("id")
+        if not payment_id:
+            return
+        ttl = self.final_ttl if payment.get("status") in YOOKASSA_FINAL_STATUSES else self.ttl
+        now = time.monotonic()
+        if len(self._items) >= self.maxsize:
+            self._items = {k: v for k, v in self._items.items() if v[0] > now}
+            while len(self._items) >= self.maxsize:
+                self._items.pop(next(iter(self._items)))
+        self._items[payment_id] = (now + ttl, payment)
+
+    async def get(self, payment_id: str) -> dict:
+        item = self._items.get(payment_id)
+        if item and item[0] > time.monotonic():
+            self.hits += 1
+            return item[1]
+
+        fut = self._inflight.get(payment_id)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[payment_id] = fut
+        try:
+            payment = await yk_get_payment(payment_id)
+            self.put(payment)
+            fut.set_result(payment)
+            return payment
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # помечаем как прочитанное, даже если никто больше не ждёт
+            raise
+        finally:
+            if not fut.done():
+                fut.cancel()
+            self._inflight.pop(payment_id, None)
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+
+payment_status = PaymentStatusCache()
+
+# ---------------- Исходящие сообщения ----------------
+# сообщений/с на бота (лимит Telegram ~30) — делим между воркерами
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", str(25 / WEB_CONCURRENCY)))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))           # сообщений/с в один личный чат
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", str(18 / 60)))  # в группу (лимит ~20/мин)
+TG_SEND_WORKERS = int(os.getenv("TG_SEND_WORKERS", "16"))
+TG_SEND_RETRIES = int(os.getenv("TG_SEND_RETRIES", "3"))
+
+PRIORITY_NORMAL = 0
+PRIORITY_BULK = 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд подождать до отправки."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+_in_outbox = contextvars.ContextVar("in_outbox", default=False)
+
+
+class Outbox:
+    """Очередь исходящих вызовов Bot API с глобальным и початовым token bucket.
+    429 (retry_after) не глотается: вызов откладывается на указанное время и повторяется,
+    а весь бот (глобальный bucket) на это время замолкает — flood-wait в Telegram общий.
+    Рассылки идут с PRIORITY_BULK и не задерживают ответы пользователям.
+
+    Прямые ответы хендлеров (m.answer, cb.answer, edit_text) в очередь не попадают, но
+    OutboxBudgetMiddleware списывает их с того же глобального bucket."""
+
+    def __init__(self, workers: int = TG_SEND_WORKERS, global_rate: float = TG_GLOBAL_RATE,
+                 chat_rate: float = TG_CHAT_RATE, group_rate: float = TG_GROUP_RATE,
+                 retries: int = TG_SEND_RETRIES):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.retries = retries
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._chats = {}
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle()}
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate)
+        return bucket
+
+    async def call(self, chat_id: int, method, /, *args, priority: int = PRIORITY_NORMAL, **kwargs):
+        """Поставить вызов method(*args, **kwargs) в очередь и дождаться результата."""
+        if not self._tasks:
+            self.start()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((priority, next(self._seq), chat_id, method, args, kwargs, fut, 0))
+        return await fut
+
+    async def send(self, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.call(chat_id, bot.send_message, chat_id, text, priority=priority, **kwargs)
+
+    def _requeue_later(self, delay: float, item: tuple):
+        # не держим воркер в sleep на весь retry_after — вернём вызов в очередь по таймеру
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, item)
+
+    async def _worker(self):
+        _in_outbox.set(True)
+        while True:
+            priority, seq, chat_id, method, args, kwargs, fut, attempt = await self._queue.get()
+            try:
+                if fut.done():
+                    continue
+                chat = self._chat_bucket(chat_id)
+                await asyncio.sleep(max(chat.reserve(), self._global.reserve()))
+                try:
+                    result = await method(*args, **kwargs)
+                except TelegramRetryAfter as e:
+                    chat.block(e.retry_after)
+                    self._global.block(e.retry_after)
+                    if attempt >= self.retries:
+                        raise
+                    self.retried += 1
+                    self._requeue_later(e.retry_after,
+                                        (priority, seq, chat_id, method, args, kwargs, fut, attempt + 1))
+                    continue
+                self.sent += 1
+                fut.set_result(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._queue = asyncio.PriorityQueue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout: float = 10):
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def stats(self) -> dict:
+        return {"depth": self.depth(), "sent": self.sent, "failed": self.failed, "retried": self.retried}
+
+
+outbox = Outbox()
+
+
+class OutboxBudgetMiddleware(BaseRequestMiddleware):
+    """Вызовы Bot API мимо Outbox (ответы хендлеров) тоже тратят глобальный лимит бота
+    и уважают его flood-wait; початовые лимиты для них не применяются."""
+
+    def __init__(self, box: Outbox):
+        self.box = box
+
+    async def __call__(self, make_request, bot, method):
+        if _in_outbox.get():
+            return await make_request(bot, method)
+        wait = self.box._global.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self.box._global.block(e.retry_after)
+            raise
+
 
-def yk_get_payment(payment_id: str) -> dict:
-    url = f"https://api.yookassa.ru/v3/payments/{payment_id}"
-    r = requests.get(url, auth=yk_auth(), timeout=20)
-    if r.status_code != 200:
-        raise RuntimeError(f"YooKassa get payment error: {r.status_code} {r.text}")
-    return r.json()
+bot.session.middleware(OutboxBudgetMiddleware(outbox))
 
 # ---------------- Логика выдачи доступа ----------------
-async def issue_link() -> str:
-    expire_date = int(time.time()) + 24 * 3600
+INVITE_LINK_TTL = 24 * 3600
+INVITE_POOL_SIZE = int(os.getenv("INVITE_POOL_SIZE", "5"))
+INVITE_REUSE_MIN_TTL = int(os.getenv("INVITE_REUSE_MIN_TTL", "21600"))  # повторно отдаём, если живёт ещё 6 ч
+# более старые из пула не раздаём; по умолчанию — пока у ссылки остаётся INVITE_REUSE_MIN_TTL,
+# чтобы простаивающий бот не перевыпускал пул каждый час
+INVITE_POOL_MAX_AGE = int(os.getenv("INVITE_POOL_MAX_AGE", str(INVITE_LINK_TTL - INVITE_REUSE_MIN_TTL)))
+INVITE_REFILL_INTERVAL = float(os.getenv("INVITE_REFILL_INTERVAL", "60"))
+
+async def issue_link(expire_date: int = None) -> str:
+    if expire_date is None:
+        expire_date = int(time.time()) + INVITE_LINK_TTL
     res = await bot.create_chat_invite_link(chat_id=GROUP_ID, member_limit=1, expire_date=expire_date)
     return res.invite_link
 
+
+class InviteLinkPool:
+    """Пул заранее созданных одноразовых ссылок в GROUP_ID (хранится в invite_links).
+    Подтверждение оплаты берёт ссылку из пула без похода в Bot API, а повторный запрос
+    по тому же заказу возвращает уже выданную, пока она не использована и не истекла.
+    Пул пополняется в фоне; состарившиеся невыданные ссылки отзываются в Telegram, а не просто
+    забываются — иначе они оставались бы рабочими входами в группу до конца своих 24 часов."""
+
+    def __init__(self, size: int = INVITE_POOL_SIZE, max_age: int = INVITE_POOL_MAX_AGE,
+                 reuse_min_ttl: int = INVITE_REUSE_MIN_TTL, refill_interval: float = INVITE_REFILL_INTERVAL):
+        self.size = size
+        self.max_age = max_age
+        self.reuse_min_ttl = reuse_min_ttl
+        self.refill_interval = refill_interval
+        self._refill = None
+        self._task = None
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self.reused = 0
+        self.minted = 0
+        self.revoked = 0
+
+    async def _mint(self, invoice_id: str = None) -> str:
+        now = int(time.time())
+        link = await issue_link(now + INVITE_LINK_TTL)
+        await db_add_invite_link(link, now, now + INVITE_LINK_TTL, invoice_id)
+        self.minted += 1
+        return link
+
+    async def get_for_order(self, inv_id: str) -> str:
+        now = int(time.time())
+        link = await db_get_order_link(inv_id, now + self.reuse_min_ttl)
+        if link:
+            self.reused += 1
+            return link
+
+        link = await db_take_pool_link(inv_id, now - self.max_age, now + self.reuse_min_ttl)
+        if link:
+            self.pool_hits += 1
+        else:
+            self.pool_misses += 1
+            link = await self._mint(inv_id)
+        if self._refill is not None:
+            self._refill.set()
+        return link
+
+    async def _drop_stale(self, now: int):
+        for link in await db_get_stale_pool_links(now - self.max_age, now):
+            try:
+                await bot.revoke_chat_invite_link(chat_id=GROUP_ID, invite_link=link)
+            except TelegramBadRequest:
+                pass  # ссылка уже недействительна в Telegram
+            except Exception:
+                metrics.swallowed("invite_revoke")
+                continue  # не отозвали — оставим в базе и попробуем на следующем проходе
+            await db_delete_pool_link(link)
+            self.revoked += 1
+
+    async def fill(self):
+        now = int(time.time())
+        await self._drop_stale(now)
+        missing = self.size - await db_count_pool_links(now - self.max_age, now + self.reuse_min_ttl)
+        for _ in range(max(missing, 0)):
+            await self._mint()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.fill()
+            except Exception as e:
+                metrics.swallowed("invite_pool")
+                log_event("INVITE_POOL_ERROR", logging.ERROR, error=str(e))
+            self._refill.clear()
+            try:
+                await asyncio.wait_for(self._refill.wait(), timeout=self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._refill = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"pool_hits": self.pool_hits, "pool_misses": self.pool_misses, "reused": self.reused, "minted": self.minted,
+                "revoked": self.revoked}
+
+
+invite_links = InviteLinkPool()
+
+GRANTING_TIMEOUT = int(os.getenv("GRANTING_TIMEOUT", "120"))
+GRANTING_RECOVERY_INTERVAL = float(os.getenv("GRANTING_RECOVERY_INTERVAL", "60"))
+
+@timed("bot_op_seconds", "op", "grant_access")
 async def grant_access(inv_id: str):
-    order = db_get_order(inv_id)
-    if not order or order["status"] == "paid":
+    # pending -> granting одним условным UPDATE: вебхук и «проверить» могут прийти
+    # одновременно, доступ выдаёт только выигравший
+    if not await db_transition_order(inv_id, "pending", "granting"):
+        return
+    with log_context(invoice_id=inv_id):
+        await deliver_access(inv_id)
+
+@timed("bot_op_seconds", "op", "deliver_access")
+async def deliver_access(inv_id: str):
+    order = await db_get_order(inv_id)
+    if not order or order["status"] != "granting":
         return
 
-    link = await issue_link()
-    db_update_order_status(inv_id, "paid")
+    link = await invite_links.get_for_order(inv_id)
 
-    user = db_get_user(order["user_id"]) or {}
-    name = user.get("name") or "Друг"
+    user = await user_cache.get(order["user_id"]) or {}
+    name = user.get("name") or t("greeting_name")
     plan_id = order.get("plan_id")
 
-    msg = (
-        f"Оплата подтверждена ✅\n\n"
-        f"Ура, {name}! 🎉\n"
-        f"🆔 Номер заказа: `{inv_id}`\n\n"
-        f"⬇️ **ПЕРЕШЛИТЕ ЭТО СООБЩЕНИЕ РЕБЕНКУ** ⬇️\n\n"
-        f"Вот персональная ссылка для входа в закрытую группу.\n"
-        f"Ссылка одноразовая и действует 24 часа.\n\n"
-        f"{link}\n"
-    )
-
+    msg = t("access_granted", name=name, inv_id=inv_id, link=link)
     if plan_id in ("pro", "test"):
-        msg += (
-            f"\nПакет включает сопровождение.\n"
-            f"Напиши эксперту: @{EXPERT_USERNAME}\n"
-            f"Секретное слово: `{SECRET_WORD}`\n"
-            f"И номер заказа: `{inv_id}`\n"
-        )
+        msg += t("access_expert_note", inv_id=inv_id)
 
-    await bot.send_message(order["user_id"], msg)
+    try:
+        await outbox.send(order["user_id"], msg)
+    except TelegramForbiddenError:
+        pass  # бот заблокирован — ссылку можно будет получить кнопкой «Получить ссылку ещё раз»
+    # если send_message упал иначе, заказ останется в granting и его подберёт recover_granting_orders
+    await db_transition_order(inv_id, "granting", "paid")
+    log_event("ACCESS_GRANTED", invoice_id=inv_id, plan_id=plan_id)
+
+async def recover_granting_orders():
+    # Заказы, застрявшие в granting (процесс упал между выдачей ссылки и "paid")
+    for inv_id in await db_claim_stuck_orders("granting", int(time.time()) - GRANTING_TIMEOUT):
+        try:
+            await deliver_access(inv_id)
+        except Exception as e:
+            metrics.swallowed("grant_recovery")
+            log_event("GRANT_RECOVERY_ERROR", logging.ERROR, invoice_id=inv_id, error=str(e))
+
+granting_recovery = PeriodicTask("grant_recovery", GRANTING_RECOVERY_INTERVAL, recover_granting_orders)
+
+# ---------------- Сверка с YooKassa ----------------
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "300"))
+RECONCILE_LOOKBACK = int(os.getenv("RECONCILE_LOOKBACK", str(2 * 24 * 3600)))  # глубже не смотрим
+RECONCILE_MAX_ORDERS = int(os.getenv("RECONCILE_MAX_ORDERS", "5000"))
+RECONCILE_PAGE_LIMIT = 100  # максимум YooKassa для списка
+
+async def reconcile_pending_orders():
+    """Подбирает оплаты, по которым потерялся вебхук: один постраничный обход
+    GET /payments?status=succeeded&created_at.gte=... вместо запроса на каждый заказ."""
+    since = int(time.time()) - RECONCILE_LOOKBACK
+    pending = await db_get_pending_orders(since, RECONCILE_MAX_ORDERS)
+    if not pending:
+        return 0
+
+    by_invoice = {inv_id: payment_id for inv_id, payment_id, _ in pending}
+    by_payment = {payment_id: inv_id for inv_id, payment_id, _ in pending if payment_id}
+    oldest = pending[0][2] - 60  # запас на расхождение часов
+    params = {
+        "status": "succeeded",
+        "created_at.gte": datetime.fromtimestamp(oldest, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "limit": RECONCILE_PAGE_LIMIT,
+    }
+
+    granted = 0
+    while True:
+        page = await yk_list_payments(params)
+        for payment in page.get("items") or []:
+            inv = (payment.get("metadata") or {}).get("invoice_id")
+            if inv not in by_invoice:
+                inv = by_payment.get(payment.get("id"))
+            if not inv or payment.get("status") != "succeeded":
+                continue
+            payment_status.put(payment)
+            by_invoice.pop(inv, None)
+            try:
+                await grant_access(inv)
+            except Exception as e:
+                # заказ остался в granting — его подберёт recover_granting_orders; остальные не ждут
+                metrics.swallowed("reconcile_grant")
+                log_event("RECONCILE_GRANT_ERROR", logging.ERROR, invoice_id=inv, error=str(e))
+                continue
+            granted += 1
+        cursor = page.get("next_cursor")
+        if not cursor or not by_invoice:
+            break
+        params = {**params, "cursor": cursor}
+
+    if granted:
+        log_event("YOOKASSA_RECONCILED", granted=granted)
+    return granted
+
+reconciler = PeriodicTask("reconcile", RECONCILE_INTERVAL, reconcile_pending_orders)
+
+# ---------------- Хранение и архив ----------------
+ORDER_PENDING_TTL = int(os.getenv("ORDER_PENDING_TTL", str(3 * 24 * 3600)))      # потом pending -> expired
+ORDER_ARCHIVE_AFTER = int(os.getenv("ORDER_ARCHIVE_AFTER", str(180 * 24 * 3600)))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), "archive"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "600"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "500"))
+RETENTION_MAX_BATCHES = int(os.getenv("RETENTION_MAX_BATCHES", "20"))  # за один проход
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "200"))
+VACUUM_MAX_STEPS = int(os.getenv("VACUUM_MAX_STEPS", "50"))
+RETENTION_PAUSE = 0.05  # между пачками — отдаём SQLite обработчикам
+SEEN_KEYS_TTL = 24 * 3600  # Telegram повторяет апдейты не дольше суток
+
+async def run_retention():
+    """Держит горячие таблицы маленькими: брошенные pending -> expired, старые заказы
+    в финальном статусе -> архив, просроченные ссылки удаляются, а освободившиеся
+    страницы возвращаются небольшими шагами incremental_vacuum, не блокируя базу надолго."""
+    now = int(time.time())
+    expired = 0
+    for _ in range(RETENTION_MAX_BATCHES):
+        n = await db_expire_pending_orders(now - ORDER_PENDING_TTL, RETENTION_BATCH)
+        expired += n
+        if n < RETENTION_BATCH:
+            break
+        await asyncio.sleep(RETENTION_PAUSE)
+
+    archived = 0
+    for _ in range(RETENTION_MAX_BATCHES):
+        n = await db_archive_orders(now - ORDER_ARCHIVE_AFTER, RETENTION_BATCH, ARCHIVE_DIR)
+        archived += n
+        if n < RETENTION_BATCH:
+            break
+        await asyncio.sleep(RETENTION_PAUSE)
+
+    await db_delete_expired_invite_links(now - 7 * 24 * 3600)
+    await db_prune_seen(now - SEEN_KEYS_TTL)
+
+    for _ in range(VACUUM_MAX_STEPS):
+        if not await db_incremental_vacuum(VACUUM_STEP_PAGES):
+            break
+        await asyncio.sleep(RETENTION_PAUSE)
+
+    metrics.inc("orders_expired_total", (), expired)
+    metrics.inc("orders_archived_total", (), archived)
+    if expired or archived:
+        log_event("RETENTION", expired=expired, archived=archived)
+
+retention = PeriodicTask("retention", RETENTION_INTERVAL, run_retention)
+
+# ---------------- Напоминания ----------------
+REMINDER_DELAY = int(os.getenv("REMINDER_DELAY", "3600"))
+REMINDER_LOOKAHEAD = int(os.getenv("REMINDER_LOOKAHEAD", "600"))
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", "500"))
+
+
+class ReminderScheduler:
+    """Одна задача на все напоминания. Сроки хранятся в таблице reminders, в памяти — только
+    min-heap ближайших (не дальше lookahead секунд вперёд и не больше batch штук), поэтому
+    память не растёт с числом pending-заказов, а после рестарта всё подхватывается из БД."""
+
+    def __init__(self, lookahead: int = REMINDER_LOOKAHEAD, batch: int = REMINDER_BATCH):
+        self.lookahead = lookahead
+        self.batch = batch
+        self._heap = []       # (due_at, invoice_id)
+        self._queued = set()
+        self._horizon = 0     # всё, что в БД с due_at <= horizon, уже в heap
+        self._truncated = False  # последний _load упёрся в batch: за horizon в БД есть ещё
+        self._wakeup = None
+        self._task = None
+        self.sent = 0
+
+    def _push(self, due_at: int, inv_id: str):
+        if inv_id not in self._queued:
+            self._queued.add(inv_id)
+            heapq.heappush(self._heap, (due_at, inv_id))
+
+    async def _load(self):
+        until = int(time.time()) + self.lookahead
+        rows = await db_get_due_reminders(until, self.batch)
+        for inv_id, due_at in rows:
+            self._push(due_at, inv_id)
+        self._truncated = len(rows) >= self.batch
+        self._horizon = rows[-1][1] if self._truncated else until
+
+    def _needs_load(self, now: float) -> bool:
+        if self._truncated:
+            # в heap целая пачка: перечитывать БД до её разбора бессмысленно — вернутся те же строки
+            return not self._heap
+        return now + self.lookahead / 2 >= self._horizon
+
+    def schedule(self, inv_id: str, due_at: int):
+        # дальние сроки остаются только в БД — их подберёт следующий _load
+        if due_at > self._horizon:
+            return
+        self._push(due_at, inv_id)
+        if self._wakeup is not None and self._heap[0][1] == inv_id:
+            self._wakeup.set()
+
+    async def _fire(self, inv_ids: list):
+        for inv_id, user_id in await db_claim_reminders(inv_ids):
+            try:
+                await outbox.send(user_id, t("reminder"))
+                self.sent += 1
+            except Exception:
+                metrics.swallowed("reminder")
+
+    async def _run(self):
+        while True:
+            try:
+                now = time.time()
+                if self._needs_load(now):
+                    await self._load()
+
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < self.batch:
+                    _, inv_id = heapq.heappop(self._heap)
+                    self._queued.discard(inv_id)
+                    due.append(inv_id)
+                if due:
+                    await self._fire(due)
+                    continue
+
+                next_at = self._horizon if self._truncated else self._horizon - self.lookahead / 2
+                if self._heap:
+                    next_at = min(next_at, self._heap[0][0])
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_at - now, 0.05))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.swallowed("reminder_loop")
+                log_event("REMINDER_ERROR", logging.ERROR, error=str(e))
+                await asyncio.sleep(5)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"queued": len(self._heap), "sent": self.sent}
+
+
+reminders = ReminderScheduler()
+
+# ---------------- Приветствия в группе ----------------
+WELCOME_WINDOW = float(os.getenv("WELCOME_WINDOW", "30"))  # сек, копим входы в одно приветствие
+WELCOME_DELETE_PREVIOUS = os.getenv("WELCOME_DELETE_PREVIOUS", "1") == "1"
+WELCOME_MAX_NAMES = 15
+WELCOME_DEDUP_TTL = 600  # один и тот же вход приходит и как сообщение, и как chat_member
+
+
+class WelcomeAggregator:
+    """Собирает входы в группу за окно WELCOME_WINDOW и отправляет одно приветствие со
+    всеми именами вместо двух сообщений на каждого (new_chat_members + chat_member).
+    Предыдущее приветствие при желании удаляется, чтобы не засорять чат.
+
+    Окно и «предыдущее приветствие» — свои в каждом воркере: при WEB_CONCURRENCY > 1 всплеск
+    входов может дать по приветствию на воркер. Дубли одного входа отсекаются через SQLite."""
+
+    def __init__(self, window: float = WELCOME_WINDOW, delete_previous: bool = WELCOME_DELETE_PREVIOUS):
+        self.window = window
+        self.delete_previous = delete_previous
+        self._pending = {}   # chat_id -> {user_id: имя}
+        self._timers = {}    # chat_id -> Task
+        self._recent = OrderedDict()  # (chat_id, user_id) -> когда поприветствовали
+        self._last_message = {}  # chat_id -> message_id прошлого приветствия
+        self.joins = 0
+        self.sent = 0
+
+    async def add(self, chat_id: int, user_id: int, name: str):
+        now = time.monotonic()
+        while self._recent and next(iter(self._recent.values())) < now - WELCOME_DEDUP_TTL:
+            self._recent.popitem(last=False)
+        key = (chat_id, user_id)
+        if key in self._recent:
+            return
+        self._recent[key] = now
+        # при нескольких воркерах второй источник того же входа может прийти в другой процесс
+        if WEB_CONCURRENCY > 1 and not await db_claim_seen(f"join:{chat_id}:{user_id}", WELCOME_DEDUP_TTL):
+            return
+        self.joins += 1
+        self._pending.setdefault(chat_id, {})[user_id] = name
+        if chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.create_task(self._flush_later(chat_id))
 
-async def reminder_task(inv_id: str):
-    await asyncio.sleep(3600)
-    order = db_get_order(inv_id)
-    if order and order["status"] == "pending":
+    async def _flush_later(self, chat_id: int):
         try:
-            await bot.send_message(order["user_id"], f"Похоже, вы не завершили оплату 🙂\nНужна помощь? Напишите @{ADMIN_USERNAME}")
+            await asyncio.sleep(self.window)
+        finally:
+            self._timers.pop(chat_id, None)
+        await self.flush(chat_id)
+
+    @staticmethod
+    def _text(names: list) -> str:
+        shown = ", ".join(names[:WELCOME_MAX_NAMES])
+        if len(names) > WELCOME_MAX_NAMES:
+            shown = t("welcome_more", shown=shown, more=len(names) - WELCOME_MAX_NAMES)
+        return t("welcome", names=shown)
+
+    async def flush(self, chat_id: int):
+        joined = self._pending.pop(chat_id, None)
+        if not joined:
+            return
+        try:
+            msg = await outbox.send(chat_id, self._text(list(joined.values())))
+            self.sent += 1
         except Exception:
-            pass
+            metrics.swallowed("welcome")
+            return
+        previous = self._last_message.get(chat_id)
+        self._last_message[chat_id] = msg.message_id
+        if self.delete_previous and previous:
+            try:
+                await outbox.call(chat_id, bot.delete_message, chat_id=chat_id, message_id=previous)
+            except Exception:
+                metrics.swallowed("welcome_delete")
+
+    async def close(self):
+        for task in list(self._timers.values()):
+            task.cancel()
+        self._timers.clear()
+        for chat_id in list(self._pending):
+            await self.flush(chat_id)
+
+    def stats(self) -> dict:
+        return {"pending": sum(len(v) for v in self._pending.values()), "joins": self.joins, "sent": self.sent}
+
+
+welcomes = WelcomeAggregator()
+
+def member_name(user) -> str:
+    return user.full_name or (f"@{user.username}" if user.username else t("fallback_name"))
 
 # ---------------- Handlers ----------------
 @dp.message(CommandStart())
@@ -284,105 +2243,240 @@ async def start(m: Message):
     if m.chat.type in ["group", "supergroup"]:
         return
 
-    u = db_get_user(m.from_user.id)
+    u = await user_cache.get(m.from_user.id)
 
     # ✅ Если пользователь уже зарегистрирован — НЕ спрашиваем заново
     if u and u.get("step") == "done" and u.get("email"):
-        name = u.get("name") or m.from_user.first_name or "друг"
-        await m.answer(f"Привет, {name}! 🙂\nВыбирай пакет:", reply_markup=kb_main())
+        name = u.get("name") or m.from_user.first_name or t("fallback_name")
+        await m.answer(t("start_known", name=name), reply_markup=kb_main())
         return
 
     # иначе стартуем onboarding
-    db_upsert_user(m.from_user.id, name=None, email=None, step="name", last_invoice_id=None)
-    await m.answer("Привет! 🙂 Я помогу оформить доступ в закрытую группу.\n\nКак тебя зовут?")
+    await user_cache.update(m.from_user.id, name=None, email=None, step="name", last_invoice_id=None)
+    await m.answer(t("start_new"))
 
-# ✅ Приветствие в группе (самый стабильный вариант)
+# ✅ Приветствие в группе: оба источника входов кладут в общий агрегатор
 @dp.message(F.new_chat_members)
 async def welcome_new_members_message(m: Message):
     if m.chat.id != GROUP_ID:
         return
-    try:
-        await m.answer(
-            "Добро пожаловать в группу! 👋\n\n"
-            "Изучи правила в закреплённом сообщении.\n"
-            "Если у тебя пакет с сопровождением — напиши эксперту."
-        )
-    except Exception:
-        pass
+    for user in m.new_chat_members:
+        if not user.is_bot:
+            await welcomes.add(m.chat.id, user.id, member_name(user))
 
-# (оставляем как было — пусть живёт, не ломаем)
 @dp.chat_member()
 async def welcome_new_member(event: ChatMemberUpdated):
-    if event.new_chat_member.status == "member":
-        try:
-            await bot.send_message(
-                event.chat.id,
-                "Добро пожаловать в группу! 👋\n\nИзучи правила в закрепленном сообщении."
-            )
-        except Exception:
-            pass
+    if event.invite_link:
+        # одноразовая ссылка использована — повторно её не выдаём
+        await db_mark_invite_used(event.invite_link.invite_link)
+    if event.chat.id != GROUP_ID:
+        return
+    joined = event.new_chat_member.status == "member" and \
+        event.old_chat_member.status not in ("member", "administrator", "creator")
+    user = event.new_chat_member.user
+    if joined and not user.is_bot:
+        await welcomes.add(event.chat.id, user.id, member_name(user))
 
 @dp.message(Command("test_link"))
 async def test_cmd(m: Message):
     # ✅ в группах не реагируем
     if m.chat.type in ["group", "supergroup"]:
         return
-    await m.answer(f"Тест генерации ссылки: {await issue_link()}")
+    await m.answer(t("test_link", link=await issue_link()))
+
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+
+_broadcasts = set()  # держим ссылки на фоновые рассылки, чтобы их не собрал GC
+
+def is_admin(user) -> bool:
+    return bool(user) and user.id in ADMIN_IDS
+
+async def run_broadcast(admin_chat_id: int, progress_message_id: int, send_one):
+    sent = failed = blocked = total = 0
+    last_report = time.monotonic()
+
+    async def report(final: bool = False):
+        head = t("broadcast_done") if final else t("broadcast_running")
+        text = t("broadcast_progress", head=head, total=total, sent=sent, blocked=blocked, failed=failed)
+        try:
+            await outbox.call(admin_chat_id, bot.edit_message_text, text=text, chat_id=admin_chat_id,
+                              message_id=progress_message_id)
+        except Exception:
+            metrics.swallowed("broadcast_report")
+
+    async for chunk in db_iter_user_ids(BROADCAST_CHUNK):
+        results = await asyncio.gather(*(send_one(uid) for uid in chunk), return_exceptions=True)
+        for res in results:
+            total += 1
+            if isinstance(res, TelegramForbiddenError):
+                blocked += 1
+            elif isinstance(res, Exception):
+                failed += 1
+            else:
+                sent += 1
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await report()
+    await report(final=True)
+
+@dp.message(Command("broadcast"))
+async def broadcast_cmd(m: Message):
+    if m.chat.type in ["group", "supergroup"]:
+        return
+    if not is_admin(m.from_user):
+        if not ADMIN_IDS:
+            log_event("BROADCAST_REFUSED", logging.WARNING, user_id=m.from_user.id, reason="ADMIN_IDS is empty")
+        return
+
+    src = m.reply_to_message
+    parts = (m.text or "").split(maxsplit=1)
+    text = parts[1] if len(parts) > 1 else ""
+    if src:
+        # ответом на сообщение — копируем его как есть (можно с фото/видео)
+        async def send_one(uid):
+            return await outbox.call(uid, bot.copy_message, chat_id=uid, from_chat_id=src.chat.id,
+                                     message_id=src.message_id, priority=PRIORITY_BULK)
+    elif text:
+        async def send_one(uid):
+            return await outbox.send(uid, text, priority=PRIORITY_BULK)
+    else:
+        await m.answer(t("broadcast_usage"))
+        return
+
+    progress = await m.answer(t("broadcast_started"))
+    task = asyncio.create_task(run_broadcast(m.chat.id, progress.message_id, send_one))
+    _broadcasts.add(task)
+    task.add_done_callback(_broadcasts.discard)
 
 @dp.message()
 async def flow(m: Message):
     if m.chat.type in ["group", "supergroup"]:
         return
 
-    u = db_get_user(m.from_user.id)
+    u = await user_cache.get(m.from_user.id)
     if not u:
-        await m.answer("Давай начнём сначала — нажми /start 🙂")
+        await m.answer(t("flow_restart"))
         return
 
     if u["step"] == "name":
         name = (m.text or "").strip()
         if len(name) < 2:
-            await m.answer("Напиши имя чуть понятнее 🙂")
+            await m.answer(t("flow_bad_name"))
             return
-        db_upsert_user(m.from_user.id, name=name, step="email")
-        await m.answer(f"Приятно познакомиться, {name}! 😊 Теперь укажи email для чека:")
+        await user_cache.update(m.from_user.id, name=name, step="email")
+        await m.answer(t("flow_ask_email", name=name))
         return
 
     if u["step"] == "email":
         email = (m.text or "").strip()
         if "@" not in email or "." not in email:
-            await m.answer("Похоже, email с ошибкой. Попробуй ещё раз 🙂")
+            await m.answer(t("flow_bad_email"))
             return
-        db_upsert_user(m.from_user.id, email=email, step="done")
-        name = db_get_user(m.from_user.id).get("name") or "друг"
-        await m.answer(f"{name}, готово ✅\nВыбирай пакет:", reply_markup=kb_main())
+        await user_cache.update(m.from_user.id, email=email, step="done")
+        name = u.get("name") or t("fallback_name")
+        await m.answer(t("flow_done", name=name), reply_markup=kb_main())
         return
 
-    await m.answer("Выбирай действие кнопками ниже 🙂", reply_markup=kb_main())
+    await m.answer(t("flow_use_buttons"), reply_markup=kb_main())
 
 @dp.callback_query(F.data == "choose_plan")
 async def plans_cb(cb: CallbackQuery):
-    await cb.message.edit_text("Доступные пакеты:", reply_markup=kb_plans())
+    await cb.message.edit_text(t("plans"), reply_markup=kb_plans())
     await cb.answer()
 
+PAYMENT_REUSE_WINDOW = int(os.getenv("PAYMENT_REUSE_WINDOW", "1800"))  # сек, сколько отдаём тот же платёж
+PAYMENT_CLAIM_TTL = int(YOOKASSA_DEADLINE) + 15  # заявка воркера на создание платежа, если он упал посреди
+PAYMENT_CLAIM_POLL = 0.5
+
+
+class KeyedLocks:
+    """asyncio.Lock на ключ; запись удаляется, когда её никто не держит и не ждёт."""
+
+    def __init__(self):
+        self._locks = {}  # key -> [lock, пользователей]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(key, None)
+
+
+payment_locks = KeyedLocks()
+
 @dp.callback_query(F.data.startswith("plan:"))
 async def pay_cb(cb: CallbackQuery):
     pid = cb.data.split(":", 1)[1]
     if pid not in PLANS:
-        await cb.answer("Неизвестный пакет", show_alert=True)
+        await cb.answer(t("unknown_plan"), show_alert=True)
         return
 
-    u = db_get_user(cb.from_user.id)
+    u = await user_cache.get(cb.from_user.id)
     if not u or u.get("step") != "done" or not u.get("email"):
         await cb.answer()
-        await cb.message.edit_text("Нажми /start и введи имя + email 🙂")
+        await cb.message.edit_text(t("need_onboarding"))
         return
 
-    inv_id = f"inv_{cb.from_user.id}_{int(time.time())}"
     plan = PLANS[pid]
 
+    # двойной тап / возврат к пакету: показываем уже созданный платёж, а не создаём новый.
+    # Лок — внутри процесса; между воркерами платёж создаёт тот, кто застолбил ключ в seen_keys.
+    async with payment_locks.hold((cb.from_user.id, pid)):
+        claim = f"pay:{cb.from_user.id}:{pid}" if WEB_CONCURRENCY > 1 else None
+        if claim and not await db_claim_seen(claim, PAYMENT_CLAIM_TTL):
+            await show_claimed_payment(cb, pid, plan, claim)
+            return
+        try:
+            await create_or_reuse_payment(cb, u, pid, plan)
+        finally:
+            if claim:
+                await db_forget_seen(claim)
+
+async def show_claimed_payment(cb: CallbackQuery, pid: str, plan: dict, claim: str):
+    # платёж по этому пакету прямо сейчас создаёт другой воркер — дожидаемся его заказа
+    deadline = time.monotonic() + PAYMENT_CLAIM_TTL
+    while time.monotonic() < deadline:
+        order = await db_find_open_order(cb.from_user.id, pid, int(time.time()) - PAYMENT_REUSE_WINDOW)
+        if order:
+            await show_payment(cb, plan, pid, order["invoice_id"], order["confirmation_url"])
+            return
+        if await db_claim_seen(claim, PAYMENT_CLAIM_TTL):
+            # заявку отпустили, а заказа нет — у того воркера создание не удалось
+            await db_forget_seen(claim)
+            await cb.answer(t("payment_create_error"), show_alert=True)
+            return
+        await asyncio.sleep(PAYMENT_CLAIM_POLL)
+    await cb.answer(t("payment_in_progress"), show_alert=True)
+
+async def create_or_reuse_payment(cb: CallbackQuery, u: dict, pid: str, plan: dict):
+    open_order = await db_find_open_order(cb.from_user.id, pid, int(time.time()) - PAYMENT_REUSE_WINDOW)
+    if open_order:
+        try:
+            payment = await payment_status.get(open_order["payment_id"])
+        except Exception:
+            payment = {"status": "pending"}  # не смогли проверить — ссылка всё равно ещё рабочая
+        if payment.get("status") == "succeeded":
+            # вебхук ещё не дошёл — выдаём доступ сразу
+            await grant_access(open_order["invoice_id"])
+            await cb.answer(t("already_paid"))
+            return
+        if payment.get("status") == "pending":
+            if u.get("last_invoice_id") != open_order["invoice_id"]:
+                await user_cache.update(cb.from_user.id, last_invoice_id=open_order["invoice_id"])
+            await show_payment(cb, plan, pid, open_order["invoice_id"], open_order["confirmation_url"])
+            return
+
+    # уникален и между пакетами одного пользователя: от него считается Idempotence-Key платежа
+    inv_id = f"inv_{cb.from_user.id}_{pid}_{uuid.uuid4().hex[:8]}"
     try:
-        res = yk_create_payment(
+        res = await yk_create_payment(
             amount=plan["amount"],
             description=plan["description"],
             email=u["email"],
@@ -392,83 +2486,205 @@ async def pay_cb(cb: CallbackQuery):
         confirm_url = (res.get("confirmation") or {}).get("confirmation_url")
 
         if not payment_id or not confirm_url:
-            print("YOOKASSA_BAD_RESPONSE:", res)
-            await cb.answer("Проблема с оплатой. Напишите в поддержку.", show_alert=True)
+            log_event("YOOKASSA_BAD_RESPONSE", logging.ERROR, invoice_id=inv_id, response=res)
+            await cb.answer(t("payment_bad_response"), show_alert=True)
             return
 
-        db_create_order(inv_id, cb.from_user.id, pid, plan["amount"], "pending", payment_id)
-        db_set_user_last_invoice(cb.from_user.id, inv_id)
+        remind_at = int(time.time()) + REMINDER_DELAY
+        await db_create_user_order(inv_id, cb.from_user.id, pid, plan["amount"], "pending", payment_id, remind_at,
+                                   confirm_url)
+        user_cache.patch(cb.from_user.id, last_invoice_id=inv_id)
+        reminders.schedule(inv_id, remind_at)
+        payment_status.put(res)
 
-        asyncio.create_task(reminder_task(inv_id))
-
-        await cb.message.edit_text(
-            f"Пакет: {plan['title']}\n"
-            f"Сумма: {plan['amount']} ₽\n\n"
-            "Нажмите кнопку ниже, оплатите, и я пришлю ссылку ✅\n\n"
-            "Если оплатили, а ссылка не пришла — нажмите «✅ Я оплатил — проверить».",
-            reply_markup=kb_pay(confirm_url, inv_id, pid)
-        )
-        await cb.answer()
+        await show_payment(cb, plan, pid, inv_id, confirm_url)
 
     except Exception as e:
-        print("YOOKASSA_CREATE_ERROR:", str(e))
-        await cb.answer("Ошибка связи с платежной системой.", show_alert=True)
+        metrics.swallowed("pay_cb")
+        log_event("YOOKASSA_CREATE_ERROR", logging.ERROR, invoice_id=inv_id, error=str(e))
+        await cb.answer(t("payment_create_error"), show_alert=True)
+
+async def show_payment(cb: CallbackQuery, plan: dict, pid: str, inv_id: str, confirm_url: str):
+    await cb.message.edit_text(
+        t("payment", title=plan["title"], amount=plan["amount"]),
+        reply_markup=kb_pay(confirm_url, inv_id, pid)
+    )
+    await cb.answer()
 
 @dp.callback_query(F.data.startswith("check:"))
 async def check_cb(cb: CallbackQuery):
     inv_id = cb.data.split(":", 1)[1]
-    order = db_get_order(inv_id)
+    order = await db_get_order(inv_id)
     if not order:
-        await cb.answer("Заказ не найден.", show_alert=True)
+        await cb.answer(t("order_not_found"), show_alert=True)
         return
 
-    try:
-        p = yk_get_payment(order["payment_id"])
-        status = p.get("status")
-        if status == "succeeded":
-            await grant_access(inv_id)
-            await cb.answer("Оплата подтверждена ✅")
-        else:
-            await cb.answer(f"Пока статус: {status}. Если вы только что оплатили — подождите минуту 🙂", show_alert=True)
-    except Exception as e:
-        print("YOOKASSA_GET_ERROR:", str(e))
-        await cb.answer("Не получилось проверить оплату. Попробуйте ещё раз.", show_alert=True)
+    with log_context(invoice_id=inv_id, payment_id=order["payment_id"]):
+        try:
+            p = await payment_status.get(order["payment_id"])
+            status = p.get("status")
+            if status == "succeeded":
+                await grant_access(inv_id)
+                await cb.answer(t("payment_confirmed"))
+            else:
+                await cb.answer(t("payment_status", status=status), show_alert=True)
+        except Exception as e:
+            metrics.swallowed("check_cb")
+            log_event("YOOKASSA_GET_ERROR", logging.ERROR, error=str(e))
+            await cb.answer(t("payment_check_error"), show_alert=True)
 
 @dp.callback_query(F.data == "resend_link")
 async def resend_link(cb: CallbackQuery):
-    u = db_get_user(cb.from_user.id)
+    u = await user_cache.get(cb.from_user.id)
     if not u or not u.get("last_invoice_id"):
-        await cb.answer("Не вижу у вас заказа. Нажмите «Выбрать пакет».", show_alert=True)
+        await cb.answer(t("no_order"), show_alert=True)
         return
 
-    order = db_get_order(u["last_invoice_id"])
+    order = await db_get_order(u["last_invoice_id"])
     if not order:
-        await cb.answer("Не вижу у вас заказа. Нажмите «Выбрать пакет».", show_alert=True)
+        await cb.answer(t("no_order"), show_alert=True)
         return
 
     if order.get("status") != "paid":
-        await cb.answer("Ссылка появится после успешной оплаты 🙂", show_alert=True)
+        await cb.answer(t("link_after_payment"), show_alert=True)
         return
 
-    link = await issue_link()
-    await cb.message.answer(
-        "Вот ваша персональная ссылка для входа в закрытую группу.\n"
-        "Ссылка одноразовая и действует 24 часа.\n\n"
-        "Если вы покупали доступ для ребёнка, пожалуйста, не входите сами — просто перешлите ссылку ребёнку:\n"
-        f"{link}"
-    )
-    await cb.answer("Отправил ✅")
+    link = await invite_links.get_for_order(order["invoice_id"])
+    await cb.message.answer(t("resend_link", link=link))
+    await cb.answer(t("link_resent"))
 
 @dp.callback_query(F.data == "support")
 async def supp_cb(cb: CallbackQuery):
     await cb.answer()
-    await cb.message.edit_text(f"Поддержка: @{ADMIN_USERNAME}", reply_markup=kb_main())
+    await cb.message.edit_text(t("support"), reply_markup=kb_main())
 
 @dp.callback_query(F.data == "back")
 async def back_cb(cb: CallbackQuery):
-    await cb.message.edit_text("Меню:", reply_markup=kb_main())
+    await cb.message.edit_text(t("menu"), reply_markup=kb_main())
     await cb.answer()
 
+# ---------------- Очередь апдейтов Telegram ----------------
+TG_WORKERS = int(os.getenv("TG_WORKERS", "8"))
+TG_QUEUE_SIZE = int(os.getenv("TG_QUEUE_SIZE", "1000"))
+TG_DEDUP_WINDOW = int(os.getenv("TG_DEDUP_WINDOW", "10000"))
+
+
+def update_chat_key(update: dict):
+    """Ключ упорядочивания: апдейты одного чата обрабатываются строго по очереди."""
+    for kind in ("message", "edited_message", "channel_post", "callback_query", "my_chat_member", "chat_member"):
+        obj = update.get(kind)
+        if not obj:
+            continue
+        if kind == "callback_query":
+            msg = obj.get("message") or {}
+            chat = msg.get("chat") or obj.get("from") or {}
+        else:
+            chat = obj.get("chat") or {}
+        if chat.get("id") is not None:
+            return chat["id"]
+    return update.get("update_id")
+
+
+class UpdateQueue:
+    """Вебхук кладёт апдейт в очередь и сразу отвечает 200; пул воркеров скармливает их
+    диспетчеру. Апдейты одного чата всегда попадают в один и тот же шард (воркер), так что
+    порядок внутри чата сохраняется. Повторы от Telegram отсекаются по update_id
+    в скользящем окне.
+
+    При WEB_CONCURRENCY > 1 uvicorn раздаёт вебхуки по процессам: повторы тогда отсекаются
+    ещё и через таблицу seen_keys, а вот порядок гарантирован только внутри процесса —
+    два апдейта одного чата могут обрабатываться параллельно в разных воркерах."""
+
+    def __init__(self, workers: int = TG_WORKERS, maxsize: int = TG_QUEUE_SIZE,
+                 dedup_window: int = TG_DEDUP_WINDOW):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.dedup_window = dedup_window
+        self._queues = []
+        self._tasks = []
+        self._seen = OrderedDict()
+        self.processed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def _remember(self, update_id):
+        if update_id is None:
+            return
+        self._seen[update_id] = None
+        while len(self._seen) > self.dedup_window:
+            self._seen.popitem(last=False)
+
+    async def put(self, update: dict) -> bool:
+        """False — очередь переполнена (вебхук должен ответить ошибкой, Telegram повторит)."""
+        update_id = update.get("update_id")
+        if update_id is not None and update_id in self._seen:
+            self.duplicates += 1
+            return True
+        q = self._queues[hash(update_chat_key(update)) % self.workers]
+        if q.full():
+            self.rejected += 1
+            return False
+        shared_key = f"tg:{update_id}" if WEB_CONCURRENCY > 1 and update_id is not None else None
+        if shared_key and not await db_claim_seen(shared_key, SEEN_KEYS_TTL):
+            self.duplicates += 1
+            return True
+        try:
+            q.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            if shared_key:
+                await db_forget_seen(shared_key)  # иначе повтор от Telegram сочтём дублем
+            return False
+        self._remember(update_id)
+        return True
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            update = await q.get()
+            with log_context(update_id=update.get("update_id")):
+                try:
+                    await dp.feed_raw_update(bot, update)
+                    self.processed += 1
+                except Exception as e:
+                    self.errors += 1
+                    metrics.swallowed("tg_update")
+                    log_event("TG_UPDATE_ERROR", logging.ERROR, exc_info=e, error=str(e))
+                finally:
+                    q.task_done()
+
+    def start(self):
+        if self._tasks:
+            return
+        per_worker = max(1, self.maxsize // self.workers)
+        self._queues = [asyncio.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def close(self, timeout: float = 10):
+        # даём дообработать то, что уже принято
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "processed": self.processed,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+updates = UpdateQueue()
+
 # ---------------- Webhooks ----------------
 @app.get("/")
 async def root():
@@ -476,7 +2692,9 @@ async def root():
 
 @app.post("/telegram/webhook")
 async def tg_wh(r: Request):
-    await dp.feed_raw_update(bot, await r.json())
+    if not await updates.put(await r.json()):
+        # очередь полна — пусть Telegram повторит позже
+        return JSONResponse({"ok": False}, status_code=503)
     return {"ok": True}
 
 @app.get("/webhook/yookassa")
@@ -490,34 +2708,182 @@ async def yk_wh(r: Request):
     obj = payload.get("object") or {}
     payment_id = obj.get("id")
 
-    print("YOOKASSA_WEBHOOK_IN:", event, payment_id)
-
-    if not payment_id:
-        return {"ok": True}
+    with log_context(payment_id=payment_id):
+        log_event("YOOKASSA_WEBHOOK_IN", yk_event=event)
+        if not payment_id:
+            return {"ok": True}
+        await handle_yk_notification(r, event, obj, payment_id)
+    return {"ok": True}
 
-    try:
-        payment = yk_get_payment(payment_id)
-    except Exception as e:
-        print("YOOKASSA_GET_ERROR(webhook):", str(e))
-        return {"ok": True}
+async def handle_yk_notification(r: Request, event: str, obj: dict, payment_id: str):
+    if yk_is_trusted_source(r) and obj.get("status"):
+        # уведомление пришло с адресов YooKassa — объект платежа в нём уже актуален
+        payment = obj
+        payment_status.put(payment)
+    else:
+        try:
+            payment = await payment_status.get(payment_id)
+        except Exception as e:
+            metrics.swallowed("yk_wh")
+            log_event("YOOKASSA_GET_ERROR", logging.ERROR, source="webhook", error=str(e))
+            return
 
     status = payment.get("status")
     meta = payment.get("metadata") or {}
     inv = meta.get("invoice_id")
+    if not inv:
+        order = await db_get_order_by_payment(payment_id)
+        inv = order["invoice_id"] if order else None
 
     if event == "payment.succeeded" and status == "succeeded" and inv:
         await grant_access(inv)
 
-    return {"ok": True}
+@app.get("/metrics")
+async def metrics_endpoint(r: Request):
+    if METRICS_TOKEN:
+        token = r.headers.get("authorization", "").removeprefix("Bearer ").strip() or r.query_params.get("token")
+        if not token or not hmac.compare_digest(token, METRICS_TOKEN):
+            raise HTTPException(status_code=401, detail="unauthorized")
+    # очереди и кэши снимаем в момент scrape — на горячем пути ничего не считаем
+    gauges = {
+        "tg_updates": updates.stats(),
+        "outbox": outbox.stats(),
+        "reminders": reminders.stats(),
+        "user_cache": user_cache.stats(),
+        "payment_status_cache": payment_status.stats(),
+        "invite_links": invite_links.stats(),
+        "welcome": welcomes.stats(),
+        "log": {"queue_depth": _log_queue.qsize(), "dropped": _log_handler.dropped},
+        "yookassa": {"breaker_open": int(yookassa.breaker_state != "closed")},
+    }
+    for component, values in gauges.items():
+        for key, value in values.items():
+            metrics.set(f"bot_{component}_{key}", (), value)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# ---------------- Отчёты ----------------
+REPORT_TOKEN = os.getenv("REPORT_TOKEN")
+REPORT_EXPORT_CHUNK = int(os.getenv("REPORT_EXPORT_CHUNK", "1000"))
+MSK = timezone(timedelta(hours=3))
+
+def require_report_token(r: Request):
+    # Без REPORT_TOKEN отчёты выключены
+    token = r.headers.get("authorization", "").removeprefix("Bearer ").strip() or r.query_params.get("token")
+    if not REPORT_TOKEN or not token or not hmac.compare_digest(token, REPORT_TOKEN):
+        raise HTTPException(status_code=401, detail="unauthorized")
+
+def parse_report_range(date_from: str | None, date_to: str | None):
+    today = datetime.now(MSK).date()
+    try:
+        d_to = date.fromisoformat(date_to) if date_to else today
+        d_from = date.fromisoformat(date_from) if date_from else d_to - timedelta(days=30)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="dates must be YYYY-MM-DD")
+    return d_from, d_to
+
+@app.get("/reports/sales", dependencies=[Depends(require_report_token)])
+async def report_sales(date_from: str | None = None, date_to: str | None = None):
+    d_from, d_to = parse_report_range(date_from, date_to)
+    rows = await db_get_sales(d_from.isoformat(), d_to.isoformat())
+    days = [
+        {"day": day, "plan_id": plan_id, "orders": orders, "paid": paid,
+         "revenue": f"{Decimal(revenue) / 100:.2f}"}
+        for day, plan_id, orders, paid, revenue in rows
+    ]
+    total = sum(r[4] for r in rows)
+    return {
+        "date_from": d_from.isoformat(),
+        "date_to": d_to.isoformat(),
+        "days": days,
+        "total": {"orders": sum(r[2] for r in rows), "paid": sum(r[3] for r in rows),
+                  "revenue": f"{Decimal(total) / 100:.2f}"},
+    }
+
+@app.get("/reports/orders.csv", dependencies=[Depends(require_report_token)])
+async def report_orders_csv(date_from: str | None = None, date_to: str | None = None):
+    d_from, d_to = parse_report_range(date_from, date_to)
+    ts_from = int(datetime.combine(d_from, datetime.min.time(), MSK).timestamp())
+    ts_to = int(datetime.combine(d_to + timedelta(days=1), datetime.min.time(), MSK).timestamp())
+
+    async def rows():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["invoice_id", "user_id", "plan_id", "amount", "status", "payment_id", "created_at"])
+        after = (ts_from - 1, "")
+        while True:
+            page = await db_get_orders_page(ts_from, ts_to, after, REPORT_EXPORT_CHUNK)
+            for row in page:
+                writer.writerow(row[:-1] + (datetime.fromtimestamp(row[-1], MSK).isoformat(),))
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            if len(page) < REPORT_EXPORT_CHUNK:
+                return
+            after = (page[-1][6], page[-1][0])
+
+    filename = f"orders_{d_from.isoformat()}_{d_to.isoformat()}.csv"
+    return StreamingResponse(rows(), media_type="text/csv; charset=utf-8",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 @app.get("/return/{invoice_id}")
 async def return_page(invoice_id: str):
     return {
-        "message": "Спасибо! Если оплата прошла, бот пришлёт ссылку в течение минуты.",
+        "message": t("return_page"),
         "invoice_id": invoice_id
     }
 
+_loop_monitor = []
+
 @app.on_event("startup")
 async def on_startup():
-    init_db()
-    await bot.set_webhook(f"{PUBLIC_BASE_URL}/telegram/webhook")
+    await init_db()
+    await yookassa.start()
+    user_cache.start()
+    updates.start()
+    outbox.start()
+    _loop_monitor.append(asyncio.create_task(monitor_event_loop_lag()))
+    for lease in leases:
+        lease.start()
+    if WEB_CONCURRENCY > 1:
+        log_event("MULTI_WORKER_LIMITS", logging.WARNING, workers=WEB_CONCURRENCY,
+                  note="per-chat update ordering and welcome batching hold only within one worker")
+
+async def leader_startup():
+    # Побочные эффекты старта (регистрация вебхука) — только в воркере-лидере
+    # chat_member Telegram присылает только если он явно перечислен в allowed_updates
+    await bot.set_webhook(f"{PUBLIC_BASE_URL}/telegram/webhook",
+                          allowed_updates=dp.resolve_used_update_types())
+    try:
+        if await db_enable_incremental_vacuum():
+            log_event("DB_AUTO_VACUUM_ENABLED")
+    except sqlite3.OperationalError as e:
+        # база занята другими воркерами — попробуем при следующем старте
+        metrics.swallowed("auto_vacuum")
+        log_event("DB_AUTO_VACUUM_ERROR", logging.WARNING, error=str(e))
+
+async def _noop():
+    pass
+
+leases = [
+    Lease("leader", leader_startup, _noop),
+    Lease("reminders", reminders.start, reminders.close),
+    Lease("reconcile", reconciler.start, reconciler.close),
+    Lease("invite_pool", invite_links.start, invite_links.close),
+    Lease("grant_recovery", granting_recovery.start, granting_recovery.close),
+    Lease("retention", retention.start, retention.close),
+]
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    for task in _loop_monitor:
+        task.cancel()
+    await updates.close()
+    for lease in leases:
+        await lease.close()
+    await welcomes.close()
+    await outbox.close()
+    await user_cache.close()
+    await yookassa.close()
+    await bot.session.close()
+    db_close()
+    stop_logging()
@@ -0,0 +1,48 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("BOT_TOKEN", "123:ABC")
+os.environ.setdefault("PUBLIC_BASE_URL", "http://localhost")
+os.environ.setdefault("GROUP_ID", "-100")
+os.environ.setdefault("YOOKASSA_SHOP_ID", "test")
+os.environ.setdefault("YOOKASSA_SECRET_KEY", "test")
+os.environ["DB_FILE"] = os.path.join(_tmp, "test.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def test_full_batch_not_due_yet_does_not_poll_db(monkeypatch):
+    # пачка из batch напоминаний ещё не наступила — БД не должна перечитываться в цикле
+    main.init_db.__wrapped__()
+    due_at = int(time.time()) + 100
+    conn = main.db_connect()
+    with conn:
+        conn.execute("DELETE FROM reminders")
+        conn.executemany("INSERT INTO reminders (invoice_id, due_at) VALUES (?, ?)",
+                         [(f"inv_{i}", due_at) for i in range(5)])
+
+    calls = 0
+    load = main.db_get_due_reminders
+
+    async def counting(until, limit):
+        nonlocal calls
+        calls += 1
+        return await load(until, limit)
+
+    monkeypatch.setattr(main, "db_get_due_reminders", counting)
+
+    async def run():
+        scheduler = main.ReminderScheduler(lookahead=600, batch=3)
+        scheduler.start()
+        await asyncio.sleep(1)
+        await scheduler.close()
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert calls == 1
+    assert len(scheduler._heap) == 3